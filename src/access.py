@@ -0,0 +1,80 @@
+import logging
+import time
+
+import database
+
+log = logging.getLogger("access")
+
+ACTIVE = "active"
+REMAINING = "remaining"
+GRACE = "grace"
+EXPIRED = "expired"
+
+class AccessDecision:
+    def __init__(self, state, days_left, message=None):
+        self.state = state
+        self.days_left = days_left
+        self.message = message
+
+    @property
+    def allowed(self):
+        return self.state != EXPIRED
+
+    @property
+    def is_expired(self):
+        return self.days_left < 0
+
+class AccessPolicy:
+    # Decisions only depend on the expiration date, and most members share a handful of those, so
+    # they are cached per date. Each entry is valid until the number of days left changes, which is
+    # the next local midnight.
+
+    def __init__(self, grace_period, remaining_message_days):
+        self.grace_period = grace_period
+        self.remaining_message_days = remaining_message_days
+
+        self.decisions = {}
+
+    def rebuild(self, members):
+        now = time.time()
+
+        self.decisions = {}
+
+        for active_until in set(m.active_until for m in members):
+            self._decide(active_until, now)
+
+        log.debug("Access decisions rebuilt for %s expiration dates", len(self.decisions))
+
+    def decide(self, member):
+        now = time.time()
+
+        entry = self.decisions.get(member.active_until)
+        if entry and now < entry[1]:
+            return entry[0]
+
+        return self._decide(member.active_until, now)
+
+    def _decide(self, active_until, now):
+        days_left = int(((active_until - now) // database.ONE_DAY) + 1)
+
+        if days_left < 0:
+            if self.grace_period and -days_left < self.grace_period:
+                decision = AccessDecision(
+                    GRACE,
+                    days_left,
+                    "Membership expired. Days of grace period remaining: {}".format(
+                        self.grace_period + days_left))
+            else:
+                decision = AccessDecision(EXPIRED, days_left)
+        elif self.remaining_message_days and days_left <= self.remaining_message_days:
+            decision = AccessDecision(REMAINING, days_left, "Days remaining: {}".format(days_left))
+        else:
+            decision = AccessDecision(ACTIVE, days_left)
+
+        valid_until = active_until - (days_left - 1) * database.ONE_DAY
+        if valid_until <= now:
+            valid_until += database.ONE_DAY
+
+        self.decisions[active_until] = (decision, valid_until)
+
+        return decision
@@ -0,0 +1,501 @@
+# Benchmarks for checking the performance of the hot paths by hand. Run from the repository root:
+#
+#   venv/bin/python3 src/benchmark.py <benchmark> [args...]
+
+import configparser
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+log = logging.getLogger("benchmark")
+
+benchmarks = {}
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def write_member_export(path, count):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+
+        for i in range(count):
+            f.write(",\n" if i else "\n")
+            f.write(json.dumps({
+                "id": i + 1,
+                "name": "Member Number {}".format(i + 1),
+                "phone_number": "+35840{:07d}".format(i),
+                "active_until": "2030-01-01",
+                "public_name": "Member {}".format(i + 1) if i % 2 else None,
+                "tag_ids": "{:08x};{:014x}".format(i, i * 7919),
+            }))
+
+        f.write("\n]\n")
+
+def database_settings(address):
+    settings = configparser.ConfigParser()
+    settings.read_dict({ "database": { "address": address, "update_interval_seconds": "10" } })
+    return settings["database"]
+
+@benchmark
+def database_sync(*counts):
+    counts = [int(c) for c in counts] or [10000, 100000]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for count in counts:
+            path = os.path.join(tmpdir, "export.json")
+            write_member_export(path, count)
+
+            for mode in ["materialized", "streaming"]:
+                out = subprocess.check_output(
+                    [sys.executable, __file__, "_database_sync_child", mode, path],
+                    cwd=tmpdir)
+
+                print("{:>7} members, {:<12} {}".format(count, mode, out.decode("utf-8").strip()))
+
+@benchmark
+def _database_sync_child(mode, path):
+    import asyncio
+    import database
+
+    db = database.Database(database_settings(path))
+    before = peak_rss_kib()
+    start = time.perf_counter()
+
+    async def sync():
+        source = db.sources[0]
+
+        if mode == "materialized":
+            # What Database._update did before streaming ingestion: the whole body as a string, the
+            # whole parsed document and then the member list.
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+
+            source.update_members([database.parse_member(mdata) for mdata in json.loads(text)])
+        else:
+            source.update_from_json(*source.read_file(path))
+
+        db._merge()
+        await db.save_task
+
+    asyncio.get_event_loop().run_until_complete(sync())
+
+    elapsed = time.perf_counter() - start
+
+    print("peak RSS +{:.1f} MiB, {:.2f} s".format((peak_rss_kib() - before) / 1024, elapsed))
+
+class DictMemberInfo:
+    # MemberInfo as it was before it got __slots__ and binary tag IDs
+    def __init__(self, id, name, phone_number, active_until, public_name, tag_ids):
+        if type(tag_ids) == str:
+            tag_ids = tag_ids.replace(" ", "").lower().split(";")
+
+        self.id = id
+        self.name = name
+        self.phone_number = phone_number
+        self.active_until = active_until
+        self.public_name = public_name
+        self.tag_ids = tag_ids or []
+
+@benchmark
+def member_memory(*counts):
+    import database
+
+    counts = [int(c) for c in counts] or [10000, 100000]
+
+    for count in counts:
+        rows = [
+            (i + 1, "Member Number {}".format(i + 1), "+35840{:07d}".format(i), "2030-01-01",
+                "Member {}".format(i + 1) if i % 2 else None, "{:08x};{:014x}".format(i, i * 7919))
+            for i in range(count)
+        ]
+
+        for name, cls, parse_date in [
+                ("dict", DictMemberInfo, lambda s: int(time.mktime(time.strptime(s, "%Y-%m-%d")))),
+                ("compact", database.MemberInfo, database.parse_date)]:
+            parse_date("2030-01-01")
+
+            # The name and phone number strings are shared by both forms, so this measures the
+            # per-member overhead and the tag ID storage.
+            tracemalloc.start()
+            members = [cls(*row[:3], parse_date(row[3]), *row[4:]) for row in rows]
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print("{:>7} members, {:<8} {:6.1f} MiB, {:4.0f} bytes/member".format(
+                count, name, size / 1024 / 1024, size / count))
+
+            del members
+
+def encode_image_reference(image):
+    # Reader.draw_image before encode_image
+    data = image.getdata(0)
+    encoded = bytearray()
+
+    for line in range(0, 8):
+        for x in range(0, 128):
+            byte = 0
+
+            for y in range(line*8, line*8+8):
+                byte >>= 1
+
+                if data[y*image.width + x]:
+                    byte |= 0x80
+
+            encoded.append(byte)
+
+    return bytes(encoded)
+
+def test_images():
+    import random
+    import reader
+    from PIL import Image
+
+    class CaptureReader(reader.BaseReader):
+        def __init__(self):
+            super().__init__()
+            self.images = []
+
+        def draw_image(self, image):
+            self.images.append(image.copy())
+
+    # The screens Reader actually shows
+    r = CaptureReader()
+
+    with r.draw() as draw:
+        draw.paste(r.icons40["locked"], (64 - 20, 32 - 20))
+
+    for name in ["bell_0", "bell_1", "bell_2", "bell_3"]:
+        with r.draw() as draw:
+            draw.paste(r.icons40[name], (64 - 20, 32 - 20))
+
+    for w in [0, 40, 127]:
+        with r.draw() as draw:
+            draw.paste(r.icons20["tag"], (0, 4))
+            draw.text((24, 2), "Member Name", fill=1, font=r.font)
+            draw.text((0, 26), "2030-01-01", fill=1, font=r.font)
+            draw.rectangle((0, 56, w, 63), fill=1)
+            draw.rectangle((0, 56, 127, 63), outline=1, width=1)
+
+    images = r.images
+
+    rng = random.Random(1)
+    for _ in range(20):
+        images.append(Image.frombytes("1", (128, 64), bytes(rng.getrandbits(8) for _ in range(1024))))
+
+    return images
+
+@benchmark
+def encode_image(iterations="200"):
+    import reader
+
+    iterations = int(iterations)
+    images = test_images()
+
+    for image in images:
+        if reader.encode_image(image) != encode_image_reference(image):
+            print("Output differs from the reference implementation")
+            sys.exit(1)
+
+    print("Output identical for {} images".format(len(images)))
+
+    for name, func in [("reference", encode_image_reference), ("encode_image", reader.encode_image)]:
+        start = time.perf_counter()
+
+        for _ in range(iterations):
+            for image in images:
+                func(image)
+
+        elapsed = time.perf_counter() - start
+
+        print("{:<13} {:8.1f} us/frame".format(name, elapsed / (iterations * len(images)) * 1e6))
+
+@benchmark
+def unlocked_frame(iterations="500"):
+    import reader
+
+    iterations = int(iterations)
+
+    class NullReader(reader.BaseReader):
+        def show_frame(self, frame):
+            pass
+
+    r = NullReader()
+
+    def render(w):
+        # show_unlocked before the frame cache
+        with r.draw() as draw:
+            draw.paste(r.icons20["tag"], (0, 4))
+            draw.text((24, 2), "Member Name", fill=1, font=r.font)
+            draw.text((0, 26), "2030-01-01", fill=1, font=r.font)
+            draw.rectangle((0, 56, w, 63), fill=1)
+            draw.rectangle((0, 56, 127, 63), outline=1, width=1)
+
+    def composite(w):
+        header = r.header_frame("tag", "Member Name", "2030-01-01", False)
+        r.draw_frame(header[:reader.PROGRESS_BAR_OFFSET] + reader.progress_bar(w))
+
+    for name, func in [("render", render), ("cached", composite)]:
+        start = time.perf_counter()
+
+        for i in range(iterations):
+            func(i % 128)
+
+        elapsed = time.perf_counter() - start
+
+        print("{:<7} {:8.1f} us/frame".format(name, elapsed / iterations * 1e6))
+
+def screen_sequences(r):
+    import reader
+
+    def unlocked(is_expired):
+        frames = []
+
+        for i in range(50):
+            header = r.header_frame(
+                "tag", "Member Name", "2030-01-01", is_expired and (i % 10) < 5)
+            frames.append(
+                header[:reader.PROGRESS_BAR_OFFSET] + reader.progress_bar(128 - i * 128 // 50))
+
+        return frames
+
+    unknown = r.render(lambda draw: (
+        draw.paste(r.icons20["unknown"], (0, 2)),
+        draw.text((25, 0), "Unknown\ntag", fill=1, font=r.font)))
+
+    return [
+        ("locked", [r.icon_frames["locked"], reader.BLANK_FRAME] * 3),
+        ("doorbell", [r.icon_frames["bell_{}".format(i % 4)] for i in range(8)]),
+        ("unlocked", unlocked(False)),
+        ("unlocked expired", unlocked(True)),
+        ("unknown", [unknown]),
+    ]
+
+@benchmark
+def frame_transfer():
+    import configparser
+    import reader
+
+    settings = configparser.ConfigParser()
+    settings.read_dict({ "reader": {} })
+
+    r = reader.Reader(settings["reader"])
+    modes = ["", "partial", "rle", "partial rle"]
+
+    # Bytes on the wire, each sequence starts from a blank display
+    print("{:<17} {:>6} {:>10} {:>10} {:>10} {:>12}".format(
+        "", "frames", "full", "partial", "rle", "partial rle"))
+
+    for name, frames in screen_sequences(r):
+        totals = []
+
+        for mode in modes:
+            r._set_features(mode.encode("ascii"))
+            r.display_frame = reader.BLANK_FRAME
+            total = 0
+
+            for frame in frames:
+                previous = r.display_frame
+                cmd = r._frame_command(frame)
+
+                if cmd is None:
+                    continue
+
+                if cmd[0:1] == b"Z" and reader.decompress_frame(cmd[1:], previous) != frame:
+                    print("Compressed frame does not decompress to the original")
+                    sys.exit(1)
+
+                total += len(r._escape(cmd))
+
+            totals.append(total)
+
+        print("{:<17} {:>6} {:>10} {:>10} {:>10} {:>12}".format(name, len(frames), *totals))
+
+def render_notes_reference(notes):
+    # MockReader.beep before render_notes
+    import math
+    import struct
+
+    RATE = 44100
+    angle = 0
+    data = bytearray()
+
+    for (freq, length, duty) in notes:
+        step = freq * 2 * math.pi / RATE
+
+        for t in range(0, int(length * 0.005 * RATE)):
+            sample = (math.sin(angle) + math.sin(angle * 3) / 3 + math.sin(angle * 5) / 5
+                + math.sin(angle * 7) / 7 + math.sin(angle * 9) / 9) * (duty / 128)
+            isample = int(sample * ((2 << 14) - 1))
+            angle += step
+
+            data += struct.pack("<h", isample)
+
+    return bytes(data)
+
+@benchmark
+def beep():
+    import reader
+
+    # show_unlocked with a 10 second unlock
+    notes = tuple(reader.mml("A#10 R10 > F10 R10 A#10 R10 > F10") + [(440, 200, 16)] * 10)
+    seconds = len(render_notes_reference(notes)) / 2 / reader.SAMPLE_RATE
+
+    reader.render_notes.cache_clear()
+    reader._wave_loop.cache_clear()
+
+    for name, func in [
+            ("reference", render_notes_reference),
+            ("cold", reader.render_notes),
+            ("warm", reader.render_notes.__wrapped__),
+            ("cached", reader.render_notes)]:
+        start = time.perf_counter()
+        data = func(notes)
+        elapsed = time.perf_counter() - start
+
+        print("{:<10} {:8.1f} ms for {:.1f} s of audio".format(name, elapsed * 1000, seconds))
+
+        if len(data) != len(render_notes_reference(notes)):
+            print("Length differs from the reference implementation")
+            sys.exit(1)
+
+@benchmark
+def door_sensor(trials="50"):
+    import asyncio
+    import door
+
+    trials = int(trials)
+    pin = 12
+
+    for debounce in ["0", "20", "50"]:
+        settings = configparser.ConfigParser()
+        settings.read_dict({ "door": {
+            "lock_serial_port": "",
+            "sensor_gpio_pin": str(pin),
+            "sensor_debounce_ms": debounce,
+        } })
+
+        gpio = door.MockGpio()
+        d = door.Door(settings["door"], gpio)
+
+        changes = []
+        d.on_open_change = lambda is_open: changes.append(time.perf_counter())
+
+        async def run():
+            d.start_sensor()
+            await asyncio.sleep(0.1)
+
+            latencies = []
+            extra_changes = 0
+
+            for i in range(trials):
+                level = gpio.LOW if i % 2 == 0 else gpio.HIGH
+                del changes[:]
+
+                # A bouncing reed switch before it settles
+                for _ in range(3):
+                    gpio.set_input(pin, level)
+                    gpio.set_input(pin, gpio.HIGH - level)
+
+                start = time.perf_counter()
+                gpio.set_input(pin, level)
+
+                await asyncio.sleep(0.1 + int(debounce) / 1000)
+
+                if changes:
+                    latencies.append(changes[-1] - start)
+                    extra_changes += len(changes) - 1
+
+            return sorted(latencies), extra_changes
+
+        latencies, extra_changes = asyncio.get_event_loop().run_until_complete(run())
+
+        print("debounce {:>2} ms: {}/{} detected, median {:5.1f} ms, max {:5.1f} ms, {} extra".format(
+            debounce, len(latencies), trials,
+            latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000, extra_changes))
+
+    print("polling once per second: 0-1000 ms, 500 ms on average")
+
+# Traffic from a Huawei modem: status spam while idle and one incoming call
+MODEM_TRAFFIC = (
+    b"\r\n^RSSI:17\r\n"
+    b"\r\n^BOOT:20752212,0,0,0,72\r\n"
+    b"\r\n^RSSI:18\r\n"
+    b"\r\n^MODE:5,4\r\n"
+    b"\r\n^DSFLOWRPT:00000034,00000000,00000000,0000000000000000,0000000000000000,0000000000,0000000000\r\n"
+    b"\r\n^RSSI:17\r\n"
+    b"\r\nOK\r\n"
+    b"\r\nRING\r\n"
+    b"\r\n+CLIP: \"0401234567\",129,,,,0\r\n"
+    b"\r\nRING\r\n"
+    b"\r\n+CLIP: \"0401234567\",129,,,,0\r\n"
+    b"\r\n^CEND:1,0,104,16\r\n"
+    b"\r\n^SRVST:2\r\n"
+)
+
+class ReferenceLineReader:
+    # Modem._reader before LineFramer
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.rx_buf = b""
+
+    def data_received(self, data):
+        self.rx_buf += data
+
+        while True:
+            p = self.rx_buf.find(ord(b"\n"))
+
+            if p == -1:
+                break
+
+            line = self.rx_buf[0:p].strip()
+            self.rx_buf = self.rx_buf[p+1:]
+
+            self.on_line(line)
+
+@benchmark
+def modem_traffic(repeat="2000"):
+    import modem
+
+    settings = configparser.ConfigParser()
+    settings.read_dict({ "modem": { "serial_port": "/dev/null" } })
+
+    data = MODEM_TRAFFIC * int(repeat)
+    m = modem.Modem(settings["modem"])
+
+    for chunk_size in [64, 1024, len(data)]:
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+        for name, parser in [
+                ("reference", ReferenceLineReader(m._line_received)),
+                ("framer", modem.LineFramer(m._line_received, None)),
+                ("reference, framing only", ReferenceLineReader(lambda line: None)),
+                ("framer, framing only", modem.LineFramer(lambda line: None, None))]:
+            start = time.perf_counter()
+
+            for chunk in chunks:
+                parser.data_received(chunk)
+
+            elapsed = time.perf_counter() - start
+
+            print("{:>8} byte reads, {:<23} {:7.2f} MB/s".format(
+                chunk_size, name, len(data) / elapsed / 1e6))
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)-15s %(name)s %(message)s", level=logging.WARNING)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print("Usage: {} <benchmark> [args...]".format(sys.argv[0]))
+        print("Benchmarks: " + ", ".join(n for n in sorted(benchmarks) if not n.startswith("_")))
+        sys.exit(1)
+
+    benchmarks[sys.argv[1]](*sys.argv[2:])
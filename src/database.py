@@ -1,12 +1,18 @@
 import aiohttp
 import asyncio
+import codecs
+import collections
 import csv
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import os
+import re
 import time
 
+import snapshot
 import utils
 
 log = logging.getLogger("database")
@@ -18,17 +24,131 @@ csv.register_dialect(
 
 ONE_DAY = 60 * 60 * 24
 
+READ_CHUNK_SIZE = 64 * 1024
+
+UNKNOWN_TAG_CACHE_SIZE = 1024
+
+def encode_tag_id(tag_id):
+    if not tag_id or not isinstance(tag_id, str):
+        return None
+
+    try:
+        return bytes.fromhex(tag_id.replace(" ", "")) or None
+    except ValueError:
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date_str):
+    # Most members share a handful of expiration dates, so this also avoids a separate int object
+    # for every member.
+    return int(time.mktime(time.strptime(date_str, "%Y-%m-%d")))
+
+class JsonArrayStream:
+    # Incremental parser for a JSON array of objects. feed() returns the objects completed by each
+    # chunk so that a large array never has to be held in memory as a whole. Documents that are not
+    # arrays are buffered and returned by close() instead.
+
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self):
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ""
+        self.is_array = None
+        self.done = False
+
+    def feed(self, chunk):
+        self.buf += self.text_decoder.decode(chunk)
+
+        return self._parse()
+
+    def close(self):
+        self.buf += self.text_decoder.decode(b"", True)
+
+        if self.is_array is False or (self.is_array is None and self.buf.strip()):
+            return json.loads(self.buf)
+
+        self._parse()
+
+        if not self.done or self.buf:
+            raise ValueError("Truncated JSON array")
+
+        return None
+
+    def _parse(self):
+        items = []
+        buf = self.buf
+        pos = self.WHITESPACE.match(buf).end()
+
+        if self.is_array is None:
+            if pos == len(buf):
+                return items
+
+            self.is_array = (buf[pos] == "[")
+            pos += 1
+
+        if not self.is_array:
+            return items
+
+        while True:
+            pos = self.WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                break
+
+            if self.done:
+                raise ValueError("Unexpected data after JSON array")
+
+            c = buf[pos]
+
+            if c == "]":
+                self.done = True
+                pos += 1
+            elif c == ",":
+                pos += 1
+            elif c == "{":
+                try:
+                    item, pos = self.json_decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # Incomplete object, wait for more data
+                    break
+
+                items.append(item)
+            else:
+                raise ValueError("Expected an object in JSON array")
+
+        self.buf = buf[pos:]
+
+        return items
+
 class MemberInfo:
+    # There can be tens of thousands of these, so keep them small: no per-instance __dict__ and tag
+    # IDs stored as raw bytes instead of hex strings.
+    __slots__ = ("id", "name", "phone_number", "active_until", "public_name", "tag_uids")
+
     def __init__(self, id, name, phone_number, active_until, public_name, tag_ids):
         if type(tag_ids) == str:
-            tag_ids = tag_ids.replace(" ", "").lower().split(";")
+            tag_ids = tag_ids.split(";")
+
+        tag_uids = []
+
+        for tag_id in (tag_ids or []):
+            uid = tag_id if isinstance(tag_id, bytes) else encode_tag_id(tag_id)
+
+            if uid:
+                tag_uids.append(uid)
+            elif tag_id is not None and (not isinstance(tag_id, str) or tag_id.strip()):
+                log.warning("Ignoring invalid tag ID %r for member #%s", tag_id, id)
 
         self.id = id
         self.name = name
         self.phone_number = phone_number
         self.active_until = active_until
         self.public_name = public_name
-        self.tag_ids = tag_ids or []
+        self.tag_uids = tuple(tag_uids)
+
+    @property
+    def tag_ids(self):
+        return [uid.hex() for uid in self.tag_uids]
 
     def get_days_until_expiration(self):
         return int(((self.active_until - time.time()) // ONE_DAY) + 1)
@@ -45,100 +165,556 @@ class MemberInfo:
             and self.phone_number == other.phone_number
             and self.active_until == other.active_until
             and self.public_name == other.public_name
-            and self.tag_ids == other.tag_ids)
+            and self.tag_uids == other.tag_uids)
+
+def parse_member(mdata):
+    return MemberInfo(
+        int(mdata["id"]),
+        str(mdata["name"]),
+        str(mdata["phone_number"]),
+        parse_date(mdata["active_until"]),
+        mdata.get("public_name", None) or None,
+        mdata.get("tag_ids", None) or None)
+
+class Source:
+    # One place members are fetched from: an HTTP URL or a local CSV/JSON file. The last members
+    # successfully read are kept even if later updates fail.
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.address = settings.get("address")
+        self.timeout = settings.getfloat("timeout_seconds", fallback=10)
+
+        self.members = []
+        self.members_by_id = {}
+        self.generation = 0
+
+        self.etag = None
+        self.last_modified = None
+        self.file_stamp = None
+        self.cursor = None
+        self.content_hash = None
+
+    async def update(self, http_session):
+        if "://" in self.address:
+            headers = { "Accept-Encoding": "gzip" }
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+
+            params = { "since": self.cursor } if self.cursor else None
+
+            async with http_session.get(self.address, params=params, headers=headers) as resp:
+                if resp.status == 304:
+                    return
+
+                if resp.status >= 400 and params:
+                    # The server may reject a stale or unknown cursor, so the next update asks for
+                    # a full snapshot instead of repeating it
+                    log.warning("Update of %s with cursor failed with status %s, resetting cursor",
+                        self.name, resp.status)
+
+                    self.cursor = None
+                    self.etag = None
+                    self.last_modified = None
+
+                resp.raise_for_status()
+
+                stream = JsonArrayStream()
+                digest = hashlib.sha1()
+                new_members = []
+
+                try:
+                    async for chunk in resp.content.iter_chunked(READ_CHUNK_SIZE):
+                        digest.update(chunk)
+
+                        for mdata in stream.feed(chunk):
+                            new_members.append(parse_member(mdata))
+
+                    document = stream.close()
+                except Exception as e:
+                    log.error("Failed to deserialize data from %s. Source was not updated.",
+                        self.name, exc_info=e)
+                    return
+
+                if self.update_from_json(new_members, document, digest.digest()):
+                    self.etag = resp.headers.get("ETag")
+                    self.last_modified = resp.headers.get("Last-Modified")
+        else:
+            stat = os.stat(self.address)
+            file_stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+            if file_stamp == self.file_stamp:
+                return
+
+            try:
+                result = await asyncio.get_event_loop().run_in_executor(
+                    None, self.read_file, self.address)
+            except Exception as e:
+                log.error("Failed to deserialize data from %s. Source was not updated.",
+                    self.name, exc_info=e)
+                return
+
+            if self.update_from_json(*result):
+                self.file_stamp = file_stamp
+
+    def read_file(self, path):
+        # Runs in a worker thread, so this must not touch the state of the source.
+
+        start = time.time()
+        digest = hashlib.sha1()
+        new_members = []
+        document = None
+
+        with open(path, "rb") as f:
+            if path.endswith(".json"):
+                stream = JsonArrayStream()
+
+                for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+
+                    for mdata in stream.feed(chunk):
+                        new_members.append(parse_member(mdata))
+
+                document = stream.close()
+            else:
+                def lines():
+                    for line in f:
+                        digest.update(line)
+                        yield line.decode("utf-8")
+
+                for mdata in csv.DictReader(lines(), dialect="Renksu"):
+                    new_members.append(parse_member(mdata))
+
+        log.debug("Read %s in %.1f ms", path, (time.time() - start) * 1000)
+
+        return new_members, document, digest.digest()
+
+    def update_from_json(self, new_members, document, content_hash=None):
+        # A plain array is a full snapshot from a server that does not support delta sync and has
+        # already been parsed into new_members by JsonArrayStream. Otherwise the document is
+        # {"cursor": ..., "full": bool, "members": [...], "removed": [id, ...]} where "members"
+        # contains added and changed members unless "full" is set.
+
+        if document is None:
+            return self.update_members(new_members, None, content_hash)
+
+        if document.get("full", False):
+            return self._update_database(
+                document.get("members"),
+                document.get("cursor"),
+                content_hash)
+        else:
+            return self._apply_delta(
+                document.get("members") or [],
+                document.get("removed") or [],
+                document.get("cursor"))
+
+    def _update_database(self, data, cursor=None, content_hash=None):
+        try:
+            return self.update_members(
+                [parse_member(mdata) for mdata in data],
+                cursor,
+                content_hash)
+        except Exception as e:
+            log.error("Failed to deserialize data from %s. Source was not updated.",
+                self.name, exc_info=e)
+
+            return False
+
+    def update_members(self, new_members, cursor=None, content_hash=None):
+        # An empty list is applied like any other, it means everyone in the source has lost access.
+        # A cursor change alone is not saved, it will be saved with the next change to the members.
+        # Until then a restart just means the same delta is fetched again.
+        self.cursor = cursor
+
+        if content_hash is None or content_hash != self.content_hash:
+            self.content_hash = content_hash
+            self.set_members(new_members)
+
+        return True
+
+    def _apply_delta(self, changed, removed, cursor):
+        try:
+            changed = [parse_member(mdata) for mdata in changed]
+            removed = [int(id) for id in removed]
+
+            self.cursor = cursor
+
+            if not changed and not removed:
+                return True
+
+            log.debug("Applying delta to %s: %s changed, %s removed",
+                self.name, len(changed), len(removed))
+
+            members_by_id = dict(self.members_by_id)
+
+            for id in removed:
+                members_by_id.pop(id, None)
+
+            for m in changed:
+                members_by_id[m.id] = m
+
+            # The members no longer correspond to any full document
+            self.content_hash = None
+            self.set_members(list(members_by_id.values()))
+
+            return True
+        except Exception as e:
+            log.error("Failed to apply delta to %s. Source was not updated.", self.name, exc_info=e)
+
+            return False
+
+    def set_members(self, members):
+        members_by_id = {}
+
+        for m in members:
+            other = members_by_id.setdefault(m.id, m)
+            if other is not m:
+                log.warning("Duplicate member ID #%s in %s", m.id, self.name)
+
+        self.members = members
+        self.members_by_id = members_by_id
+        self.generation += 1
 
 class Database:
     def __init__(self, settings):
-        self.address = settings.get("address")
         self.update_interval_seconds = settings.getint("update_interval_seconds")
 
-        self.file_name = "members.json"
+        # Member numbers have to be normalized the same way as incoming calls to match them
+        self.default_country_prefix = settings.get(
+            "default_country_prefix",
+            fallback=settings.parser.get("modem", "default_country_prefix", fallback=None))
+
+        self.export_json = settings.getboolean("export_json", fallback=False)
+
+        # Sources in order of increasing precedence: a member ID, tag ID or phone number found in a
+        # later source overrides the same one in the earlier sources.
+        self.sources = [Source(settings.name, settings)]
+
+        for name in (settings.get("sources", fallback=None) or "").split(","):
+            name = name.strip()
+            if name:
+                section = settings.name + "." + name
+                self.sources.append(Source(section, settings.parser[section]))
+
+        self.file_name = "members.snapshot"
+        self.json_file_name = "members.json"
+        self.snapshot = None
         self.members = []
+        self.members_by_tag_id = {}
+        self.members_by_number = {}
+        self.merged_generations = [0] * len(self.sources)
+        self.on_update = None
+
+        # Tags recently looked up and not found, cleared whenever the members change
+        self.unknown_tags = collections.OrderedDict()
+        self.unknown_tag_hits = 0
+        self.unknown_tag_misses = 0
+
+        # Arguments to _save_to_file for the latest merge not saved yet
+        self.save_state = None
+        self.save_task = None
 
     def start(self):
         self.http_session = aiohttp.ClientSession()
 
-        self._load_from_file()
+        # Lookups are answered from the memory-mapped snapshot until the members have been loaded
+        # from it in a worker thread
+        self._open_snapshot()
+        utils.run_background(self._start_updates())
+
+    async def _start_updates(self):
+        await self._load_from_file()
 
         utils.Timer(self._update, self.update_interval_seconds, True)
 
-    async def _update(self, timeout=10):
-        if "://" in self.address:
-            async with self.http_session.get(self.address, timeout=timeout) as resp:
-                self._update_database(json.loads(await resp.text()))
-        else:
-            with open(self.address, "r", encoding="utf-8") as f:
-                self._update_database(csv.DictReader(f, dialect="Renksu"))
+    async def _update(self):
+        await asyncio.gather(*(self._update_source(source) for source in self.sources))
 
-    def _update_database(self, data):
-        if not data:
-            return
+        self._merge()
 
+    async def _update_source(self, source):
         try:
-            new_members = []
-
-            for mdata in data:
-                new_members.append(
-                    MemberInfo(
-                        int(mdata["id"]),
-                        str(mdata["name"]),
-                        str(mdata["phone_number"]),
-                        int(time.mktime(time.strptime(mdata["active_until"], "%Y-%m-%d"))),
-                        mdata.get("public_name", None) or None,
-                        mdata.get("tag_ids", None) or None))
-
-            if new_members != self.members:
-                self.members = new_members
-
-                log.debug("Database updated. Saving to file.")
-                self._save_to_file()
+            await asyncio.wait_for(source.update(self.http_session), source.timeout)
+        except asyncio.TimeoutError:
+            log.warning("Timed out updating %s", source.name)
         except Exception as e:
-            log.error("Failed to deserialize database data. Database was not updated.", exc_info=e)
+            log.error("Failed to update %s", source.name, exc_info=e)
+
+    def _merge(self, save=True):
+        generations = [source.generation for source in self.sources]
+        if generations == self.merged_generations:
+            return
+
+        source_members = [source.members for source in self.sources]
+        merged = self._merge_members(source_members)
+
+        self._apply_merge(generations, *merged)
+
+        if save:
+            # The snapshot is written from exactly what was merged here. Sources can change before
+            # the save starts, and the indexes must only point to members in these lists.
+            metadata = {
+                "sources": [
+                    {
+                        "name": source.name,
+                        "cursor": source.cursor,
+                        "content_hash": source.content_hash.hex() if source.content_hash else None,
+                    }
+                    for source in self.sources
+                ],
+            }
+
+            log.debug("Database updated. Saving to file.")
+            self.save_state = (source_members, *merged, metadata)
+
+            if not self.save_task:
+                self.save_task = utils.run_background(self._save_task())
+
+    def _merge_members(self, source_members):
+        # Also runs in a worker thread when loading the snapshot, so this must not touch any state.
 
-    def _load_from_file(self):
+        start = time.time()
+
+        if len(source_members) == 1:
+            members = source_members[0]
+        else:
+            # Highest precedence first, so that it also wins when building the indexes
+            merged = {}
+            for members in reversed(source_members):
+                for m in members:
+                    merged.setdefault(m.id, m)
+
+            members = list(merged.values())
+
+        members_by_tag_id, members_by_number = self._build_indexes(members)
+
+        log.debug("Merged and indexed %s members in %.1f ms",
+            len(members), (time.time() - start) * 1000)
+
+        return members, members_by_tag_id, members_by_number
+
+    def _apply_merge(self, generations, members, members_by_tag_id, members_by_number):
+        self.members = members
+        self.members_by_tag_id = members_by_tag_id
+        self.members_by_number = members_by_number
+        self.merged_generations = generations
+
+        self.unknown_tags = collections.OrderedDict()
+
+        if self.snapshot:
+            self.snapshot.close()
+            self.snapshot = None
+
+        utils.raise_event(self.on_update, members)
+
+    def _build_indexes(self, members):
+        members_by_tag_id = {}
+        members_by_number = {}
+
+        for m in members:
+            for uid in m.tag_uids:
+                other = members_by_tag_id.setdefault(uid, m)
+                if other is not m:
+                    log.warning("Duplicate tag ID %s for members #%s and #%s, using #%s",
+                        uid.hex(), other.id, m.id, other.id)
+
+            number = utils.normalize_phone_number(m.phone_number, self.default_country_prefix)
+            if number:
+                other = members_by_number.setdefault(number, m)
+                if other is not m:
+                    log.warning("Duplicate phone number %s for members #%s and #%s, using #%s",
+                        number, other.id, m.id, other.id)
+
+        return members_by_tag_id, members_by_number
+
+    def _open_snapshot(self):
         if not os.path.exists(self.file_name):
             return
 
         try:
-            with open(self.file_name, "r", encoding="utf-8") as f:
-                json_str = f.read()
-
-            self._update_database(json.loads(json_str))
+            self.snapshot = snapshot.Snapshot(self.file_name)
         except Exception as e:
-            log.error("Failed to load database", exc_info=e)
+            log.error("Failed to open database snapshot", exc_info=e)
+
+    async def _load_from_file(self):
+        loop = asyncio.get_event_loop()
+
+        if self.snapshot:
+            try:
+                start = time.time()
+
+                states, source_members, merged = await loop.run_in_executor(
+                    None, self._read_snapshot, self.snapshot, self.snapshot.metadata["sources"])
+
+                for source, state, members in zip(self.sources, states, source_members):
+                    if state is None:
+                        continue
+
+                    source.cursor = state["cursor"]
+                    source.content_hash = (
+                        bytes.fromhex(state["content_hash"]) if state["content_hash"] else None)
+                    source.set_members(members)
+
+                self._apply_merge([source.generation for source in self.sources], *merged)
+
+                log.debug("Loaded %s members from snapshot in %.3fs",
+                    len(self.members), time.time() - start)
+            except Exception as e:
+                log.error("Failed to load database snapshot", exc_info=e)
+        elif os.path.exists(self.json_file_name):
+            # Members saved by an older version, the snapshot is written after loading them
+            try:
+                source = self.sources[0]
+                source.update_from_json(
+                    *await loop.run_in_executor(None, source.read_file, self.json_file_name))
+
+                self._merge()
+            except Exception as e:
+                log.error("Failed to load database", exc_info=e)
+
+    def _read_snapshot(self, snapshot, states):
+        # Runs in a worker thread. Returns the saved state and members of each configured source, in
+        # the same order as self.sources, and the merged members and indexes. The snapshot is only
+        # closed on the event loop after this is done.
+
+        snapshot_members = [[] for _ in states]
+
+        for i, record in snapshot.records():
+            snapshot_members[i].append(MemberInfo(*record))
+
+        # Sources removed from the settings are dropped
+        by_name = { state["name"]: i for i, state in enumerate(states) }
+        indexes = [by_name.get(source.name) for source in self.sources]
+
+        source_members = [snapshot_members[i] if i is not None else [] for i in indexes]
+
+        return (
+            [states[i] if i is not None else None for i in indexes],
+            source_members,
+            self._merge_members(source_members))
+
+    async def _save_task(self):
+        # Only one save runs at a time. Changes made while saving are written afterwards in one go.
+        try:
+            while self.save_state:
+                save_state = self.save_state
+                self.save_state = None
+
+                await asyncio.get_event_loop().run_in_executor(
+                    None, self._save_to_file, *save_state)
+        finally:
+            self.save_task = None
+
+    def _save_to_file(self, sources, members, members_by_tag_id, members_by_number, metadata):
+        # Runs in a worker thread. Member lists and indexes are never modified after they have been
+        # built, so it is safe to read them here.
 
-    def _save_to_file(self):
         try:
+            start = time.time()
+
             temp_file_name = self.file_name + ".tmp"
 
-            with open(temp_file_name, "w", encoding="utf-8") as f:
-                f.write(json.dumps(list(map(lambda m: {
-                    "id": m.id,
-                    "name": m.name,
-                    "phone_number": m.phone_number,
-                    "active_until": time.strftime("%Y-%m-%d", time.gmtime(m.active_until)),
-                    "public_name": m.public_name,
-                    "tag_ids": m.tag_ids,
-                }, self.members)), indent=True))
+            with open(temp_file_name, "wb") as f:
+                snapshot.write_snapshot(f, sources, members_by_tag_id, members_by_number, metadata)
+
+                written = time.time()
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            synced = time.time()
 
             os.rename(temp_file_name, self.file_name)
+
+            log.debug("Saved snapshot: write %.1f ms, fsync %.1f ms, rename %.1f ms",
+                (written - start) * 1000, (synced - written) * 1000, (time.time() - synced) * 1000)
         except Exception as e:
             log.error("Failed to save database", exc_info=e)
 
+        if self.export_json:
+            self._export_json(members)
+
+    def _export_json(self, members):
+        try:
+            start = time.time()
+
+            temp_file_name = self.json_file_name + ".tmp"
+
+            # Written one member at a time to avoid building the whole document in memory
+            with open(temp_file_name, "w", encoding="utf-8") as f:
+                f.write("[")
+
+                for i, m in enumerate(members):
+                    f.write(",\n" if i else "\n")
+                    f.write(json.dumps({
+                        "id": m.id,
+                        "name": m.name,
+                        "phone_number": m.phone_number,
+                        "active_until": time.strftime("%Y-%m-%d", time.localtime(m.active_until)),
+                        "public_name": m.public_name,
+                        "tag_ids": m.tag_ids,
+                    }))
+
+                f.write("\n]\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(temp_file_name, self.json_file_name)
+
+            log.debug("Exported JSON in %.1f ms", (time.time() - start) * 1000)
+        except Exception as e:
+            log.error("Failed to export database", exc_info=e)
+
     async def get_member_by_number(self, number):
+        number = utils.normalize_phone_number(number, self.default_country_prefix)
         if not number:
             return None
 
-        return await self._find_member(lambda m: m.phone_number == number)
+        if self.snapshot:
+            return self._member_from_record(self.snapshot.find_by_number(number))
+
+        return self.members_by_number.get(number)
 
     async def get_member_by_tag_id(self, tag_id):
+        tag_id = encode_tag_id(tag_id)
         if not tag_id:
             return None
 
-        return await self._find_member(lambda m: tag_id in m.tag_ids)
+        if tag_id in self.unknown_tags:
+            self.unknown_tags.move_to_end(tag_id)
+            self.unknown_tag_hits += 1
+            return None
+
+        self.unknown_tag_misses += 1
+
+        if self.snapshot:
+            member = self._member_from_record(self.snapshot.find_by_tag(tag_id))
+        else:
+            member = self.members_by_tag_id.get(tag_id)
+
+        if member is None:
+            self.unknown_tags[tag_id] = True
+
+            if len(self.unknown_tags) > UNKNOWN_TAG_CACHE_SIZE:
+                self.unknown_tags.popitem(last=False)
+
+        return member
+
+    def get_unknown_tag_stats(self):
+        lookups = self.unknown_tag_hits + self.unknown_tag_misses
+
+        return {
+            "lookups": lookups,
+            "hits": self.unknown_tag_hits,
+            "hit_rate": round(self.unknown_tag_hits / lookups, 3) if lookups else None,
+            "size": len(self.unknown_tags),
+        }
 
-    async def _find_member(self, predicate):
-        return next((m for m in self.members if predicate(m)), None)
+    def _member_from_record(self, record):
+        return MemberInfo(*record) if record else None
 
 if __name__ == "__main__":
     logging.basicConfig(format="%(asctime)-15s %(name)s %(message)s", level=logging.DEBUG)
@@ -2,12 +2,17 @@ import asyncio
 import logging
 import os
 import serial
+import threading
 import time
 
+import latency
 import utils
 
 log = logging.getLogger("door")
 
+# The lock stays open while it receives this
+KEEPALIVE = b"\x55" * 1024
+
 class BaseDoor:
     def __init__(self):
         self.is_unlocked = False
@@ -16,6 +21,9 @@ class BaseDoor:
         self.is_open = False
         self.on_open_change = None
 
+        # Replaced with the door's tracer when used by a DoorController
+        self.latency = latency.Tracer()
+
     def _set_is_unlocked(self, is_unlocked):
         if is_unlocked != self.is_unlocked:
             self.is_unlocked = is_unlocked
@@ -59,97 +67,245 @@ class BaseDoor:
 
             return False
 
+class MockGpio:
+    # Stands in for RPi.GPIO. Edge callbacks are called from a separate thread like the real one
+    # does.
+    BOARD = "board"
+    IN = "in"
+    PUD_UP = "pud_up"
+    LOW = 0
+    HIGH = 1
+    RISING = "rising"
+    FALLING = "falling"
+    BOTH = "both"
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels.setdefault(pin, self.HIGH if pull_up_down == self.PUD_UP else self.LOW)
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def set_input(self, pin, level):
+        if self.levels.get(pin) == level:
+            return
+
+        self.levels[pin] = level
+
+        callback = self.callbacks.get(pin)
+        if callback:
+            threading.Thread(target=callback, args=(pin,)).start()
+
 class Door(BaseDoor):
-    def __init__(self, settings):
+    def __init__(self, settings, gpio=None):
         super().__init__()
 
         self.settings = settings
 
-        import RPi.GPIO as gpio
+        if not gpio:
+            import RPi.GPIO as gpio
         self.gpio = gpio
 
         self.lock_serial_port = self.settings.get("lock_serial_port")
         self.sensor_gpio_pin = self.settings.getint("sensor_gpio_pin")
+        self.sensor_debounce = self.settings.getint("sensor_debounce_ms", fallback=20) / 1000
+        self.sensor_poll_interval = self.settings.getint("sensor_poll_seconds", fallback=30)
+
+        self.loop = None
+        self.debounce_timer = None
 
         self.baud_rate = 9600
         self.port = None
+        self.writing = False
         self.bytes_left = 0
+        self.first_write = False
+        self.unlock_start = 0
         self.unlocked_until = 0
 
     def start(self):
+        self.start_sensor()
+
+        # The port stays open so that unlocking only has to start writing. If it cannot be opened
+        # now, the next unlock tries again.
+        try:
+            self._open_port()
+        except Exception as e:
+            log.error("Failed to open lock serial port", exc_info=e)
+
+    def start_sensor(self):
+        self.loop = asyncio.get_event_loop()
+
         self.gpio.setmode(self.gpio.BOARD)
         self.gpio.setup(self.sensor_gpio_pin, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
 
-        self._poll()
-        utils.Timer(self._poll, 1, True)
+        # Edges are only a hint to read the sensor once it has settled. The slow poll catches
+        # anything they miss.
+        poll_interval = self.sensor_poll_interval
 
-    def _unlock_core(self, seconds):
-        # 1 byte of data = 10 bits on line (8 data, 1 start, 1 stop)
-        self.bytes_left = int(self.baud_rate / 10 * seconds)
+        try:
+            self.gpio.add_event_detect(self.sensor_gpio_pin, self.gpio.BOTH, callback=self._edge)
+        except Exception as e:
+            log.error("Failed to set up sensor edge detection, polling instead", exc_info=e)
+            poll_interval = 1
 
-        self._close_port()
+        self._poll()
+        utils.Timer(self._poll, poll_interval, True)
 
+    def _open_port(self):
         self.port = serial.Serial(
             port=self.lock_serial_port,
             baudrate=self.baud_rate,
             timeout=0,
             write_timeout=0)
 
-        asyncio.get_event_loop().add_writer(self.port, self._writer)
-        self._writer()
+    def _unlock_core(self, seconds):
+        self.unlock_start = time.perf_counter()
+
+        # 1 byte of data = 10 bits on line (8 data, 1 start, 1 stop)
+        bytes_left = int(self.baud_rate / 10 * seconds)
 
-    def lock(self):
         try:
+            nwrite = self._start_writing(bytes_left)
+        except Exception as e:
+            # The open port goes stale if the adapter is unplugged and plugged back in
+            log.warning("Failed to write to lock serial port, reopening it", exc_info=e)
             self._close_port()
+
+            try:
+                nwrite = self._start_writing(bytes_left)
+            except:
+                self._close_port()
+                raise
+
+        self.latency.mark("lock_write_started")
+
+        if nwrite:
+            self._first_byte_written()
+        else:
+            # Noted by _writer once the port accepts data
+            self.first_write = True
+
+    def _start_writing(self, bytes_left):
+        if not self.port:
+            self._open_port()
+
+        self.bytes_left = bytes_left
+        self.first_write = False
+
+        if not self.writing:
+            asyncio.get_event_loop().add_writer(self.port, self._writer)
+            self.writing = True
+
+        # The first write is made here so that errors reach unlock()
+        return self._write()
+
+    def lock(self):
+        try:
+            # Drop what is still buffered so the lock closes right away
+            self._stop_writing(discard=True)
         except Exception as e:
             log.error("Failed to lock door", exc_info=e)
 
     def _poll(self):
         self._set_is_open(self.gpio.input(self.sensor_gpio_pin) == self.gpio.HIGH)
 
+    def _edge(self, pin):
+        # Called from the GPIO library's thread
+        self.loop.call_soon_threadsafe(self._debounce)
+
+    def _debounce(self):
+        if self.debounce_timer:
+            self.debounce_timer.cancel()
+
+        self.debounce_timer = utils.Timer(self._poll, self.sensor_debounce)
+
+    def _stop_writing(self, discard=False):
+        self.bytes_left = 0
+
+        if self.writing:
+            asyncio.get_event_loop().remove_writer(self.port)
+            self.writing = False
+
+            if discard:
+                self.port.reset_output_buffer()
+
+            self.unlocked_until = 0
+            self._set_is_unlocked(False)
+
     def _close_port(self):
-        if self.port:
+        if self.writing:
             asyncio.get_event_loop().remove_writer(self.port)
+            self.writing = False
+
+        if self.port:
             try:
                 self.port.close()
             except:
                 pass
             self.port = None
 
-            self.unlocked_until = 0
-            self._set_is_unlocked(False)
+        self.bytes_left = 0
+        self.unlocked_until = 0
+        self._set_is_unlocked(False)
+
+    def _write(self):
+        if self.bytes_left <= 0:
+            self._stop_writing()
+            return 0
+
+        nwrite = self.port.write(
+            KEEPALIVE if self.bytes_left >= len(KEEPALIVE) else KEEPALIVE[:self.bytes_left])
+        self.bytes_left -= nwrite
+
+        if self.first_write and nwrite:
+            self.first_write = False
+            self._first_byte_written()
+
+        return nwrite
+
+    def _first_byte_written(self):
+        self.latency.finish("first_byte_written")
+
+        log.info(
+            "Lock stream started %.1f ms after unlock",
+            (time.perf_counter() - self.unlock_start) * 1000)
 
     def _writer(self):
         try:
-            if self.bytes_left <= 0:
-                self._close_port()
-                return
-
-            nwrite = self.port.write(b"\x55" * min(self.bytes_left, 1024))
-            self.bytes_left -= nwrite
+            self._write()
         except Exception as e:
             log.error("Error in _writer", exc_info=e)
 
-            self.open_until = 0
-
-            try:
-                self.port.close()
-            except:
-                pass
-
-            self.port = None
+            # Reopened on the next unlock
+            self._close_port()
 
 class MockDoor(BaseDoor):
-    def __init__(self, mock, settings):
+    def __init__(self, mock, settings, name=None):
         super().__init__()
 
         self.mock = mock
         self.settings = settings
 
         self.unlock_id = 0
+        self.unlocked_until = 0
+
+        # With several doors the commands are suffixed with the door name, e.g. o.workshop
+        suffix = "" if name is None else "." + name
 
-        self.mock.add_listener("c", lambda: self._set_is_open(False))
-        self.mock.add_listener("o", lambda: self._set_is_open(True))
+        self.mock.add_listener("c" + suffix, lambda: self._set_is_open(False))
+        self.mock.add_listener("o" + suffix, lambda: self._set_is_open(True))
 
     def start(self):
         self.mock.log("Door started")
@@ -170,6 +326,7 @@ class MockDoor(BaseDoor):
             self._set_is_unlocked(False)
 
         self.mock.log("Door is unlocked")
+        self.latency.finish("lock_released")
         asyncio.ensure_future(unlock_async())
 
         return True
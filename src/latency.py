@@ -0,0 +1,81 @@
+# Latency tracing for the path from a tag read or incoming call to the lock being driven open.
+#
+# Each door has its own Tracer shared by its reader, lock and the modem when calls open it. Only one
+# trace is active per tracer at a time: a new tag read or call replaces a trace that never reached
+# the lock (unknown tag, expired membership etc.), and such traces are not recorded.
+
+import collections
+import logging
+import time
+
+log = logging.getLogger("latency")
+
+WINDOW_SIZE = 500
+OUTLIER_SECONDS = 0.5
+
+class Trace:
+    def __init__(self, method):
+        self.method = method
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def mark(self, stage):
+        self.stages.append((stage, time.perf_counter() - self.start))
+
+    def format(self):
+        return ", ".join("{} {:.1f} ms".format(stage, t * 1000) for stage, t in self.stages)
+
+class Tracer:
+    def __init__(self):
+        self.current = None
+
+        # method -> stage -> recent latencies from the start of the trace
+        self.samples = collections.defaultdict(
+            lambda: collections.defaultdict(lambda: collections.deque(maxlen=WINDOW_SIZE)))
+
+    def begin(self, method):
+        self.current = Trace(method)
+
+    def mark(self, stage):
+        if self.current:
+            self.current.mark(stage)
+
+    def finish(self, stage):
+        trace = self.current
+        if not trace:
+            return
+
+        self.current = None
+
+        trace.mark(stage)
+
+        for stage, t in trace.stages:
+            self.samples[trace.method][stage].append(t)
+
+        total = trace.stages[-1][1]
+
+        if total >= OUTLIER_SECONDS:
+            log.warning("Slow %s unlock: %s", trace.method, trace.format())
+        else:
+            log.debug("%s unlock: %s", trace.method, trace.format())
+
+    def summary(self):
+        result = {}
+
+        for method, stages in self.samples.items():
+            result[method] = {}
+
+            for stage, values in stages.items():
+                values = sorted(values)
+
+                result[method][stage] = {
+                    "count": len(values),
+                    "p50": round(_percentile(values, 0.50) * 1000, 1),
+                    "p95": round(_percentile(values, 0.95) * 1000, 1),
+                    "p99": round(_percentile(values, 0.99) * 1000, 1),
+                }
+
+        return result
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
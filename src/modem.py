@@ -2,19 +2,109 @@ import asyncio
 import logging
 import os
 import os.path
-import serial
+import serial_asyncio
+import socket
 import time
 
+import latency
 import utils
 
 log = logging.getLogger("modem")
 
+# Anything longer without a line break is garbage
+MAX_LINE_LENGTH = 4096
+
+COMMAND_TIMEOUT = 2
+
+# Final result codes that end the response to a command
+RESULT_OK = "OK"
+RESULT_ERRORS = ("ERROR", "NO CARRIER", "BUSY", "NO ANSWER", "NO DIALTONE")
+RESULT_ERROR_PREFIXES = ("+CME ERROR:", "+CMS ERROR:")
+
+class ModemError(Exception):
+    pass
+
+class LineFramer(asyncio.Protocol):
+    # Splits received data into stripped lines. Reads are appended to a buffer that is only split
+    # once it contains a line break, so each byte is copied a constant number of times however
+    # large the burst is.
+    def __init__(self, on_line, on_lost):
+        self.on_line = on_line
+        self.on_lost = on_lost
+        self.buf = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buf += data
+
+        if b"\n" not in data:
+            if len(self.buf) > MAX_LINE_LENGTH:
+                log.warning("Discarding %s bytes without a line break", len(self.buf))
+                self.buf = bytearray()
+
+            return
+
+        lines = self.buf.split(b"\n")
+        self.buf = lines.pop()
+
+        for line in lines:
+            self.on_line(line.strip())
+
+    def connection_lost(self, exc):
+        self.on_lost(self, exc)
+
+NETLINK_KOBJECT_UEVENT = 15
+
+class UeventWatcher:
+    # Calls on_event with the properties of each kernel device event. Raises OSError if netlink is
+    # not available.
+    def __init__(self, on_event):
+        self.on_event = on_event
+
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.bind((0, 1))
+            self.sock.setblocking(False)
+        except:
+            self.sock.close()
+            raise
+
+        asyncio.get_event_loop().add_reader(self.sock, self._reader)
+
+    def _reader(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+
+            # ACTION@DEVPATH followed by KEY=VALUE fields, all NUL terminated
+            fields = data.decode("utf-8", "replace").split("\0")
+            if "@" not in fields[0]:
+                continue
+
+            utils.raise_event(
+                self.on_event,
+                dict(f.split("=", 1) for f in fields[1:] if "=" in f))
+
+    def close(self):
+        asyncio.get_event_loop().remove_reader(self.sock)
+        self.sock.close()
+
+# Device nodes and their /dev/serial/by-id links are created by udev after the kernel event
+DEVICE_SETTLE_DELAYS = [0.5, 2, 5]
+
 class Modem:
     def __init__(self, settings):
         self.serial_port = settings.get("serial_port")
         self.default_country_prefix = settings.get("default_country_prefix")
         self.mode_switch_usb_id = settings.get("mode_switch_usb_id")
         self.mode_switch_command = settings.get("mode_switch_command")
+        self.mode_switch_cooldown = settings.getint("mode_switch_cooldown_seconds", fallback=60)
+        self.usb_root = settings.get("usb_root", fallback="/sys/bus/usb/devices")
 
         self.on_rssi = None
         self.ringing = False
@@ -22,27 +112,91 @@ class Modem:
         self.on_ring_start = None
         self.on_ring_end = None
 
+        # Replaced with the tracer of the door calls open
+        self.latency = latency.Tracer()
+
         self.poll_interval = 10
         self.prev_line_time = 0
-        self.rx_buf = b""
-        self.port = None
+        self.transport = None
+        self.protocol = None
+
+        # Line prefix before the colon -> handler for the rest of the line
+        self.handlers = {
+            "^RSSI": self._rssi,
+            "+CLIP": self._clip,
+            "^CEND": self._call_end,
+        }
 
         self.ring_timeout = 8
         self.prev_ring_time = 0
 
+        # Commands are sent one at a time, the response lines are collected until the final result
+        # code resolves the pending future
+        self.command_lock = asyncio.Lock()
+        self.pending_command = None
+        self.pending_response = None
+
+        # The device is looked for when the kernel reports a new one and every device_check_interval
+        # seconds in case an event was missed
+        self.watcher = None
+        self.device_check_interval = 60
+        self.next_device_check = 0
+        self.checking_device = False
+        self.last_mode_switch = None
+
     def start(self):
+        try:
+            self.watcher = UeventWatcher(self._uevent)
+        except OSError as e:
+            log.warning("Device events not available, polling for the modem instead: %s", e)
+            self.device_check_interval = 5
+
         utils.Timer(self._poll, 1, True)
 
-    def hangup(self):
-        if self.ringing:
-            self._write_ignore_errors("ATH")
+    async def hangup(self):
+        if not self.ringing:
+            return
 
-    def _poll(self):
-        if self.prev_line_time < time.time() - self.poll_interval:
-            if not self.port:
-                self._open_port()
-            else:
-                self._write_ignore_errors("AT")
+        try:
+            await self.command("ATH")
+        except ModemError as e:
+            log.warning("Hangup failed: %s", e)
+
+    async def command(self, line, timeout=COMMAND_TIMEOUT):
+        # Returns the response lines before the final result code. Raises ModemError if the modem
+        # is not connected, returns an error or does not respond in time.
+        async with self.command_lock:
+            if not self.transport:
+                raise ModemError("Modem not connected")
+
+            future = asyncio.get_event_loop().create_future()
+
+            self.pending_command = (line, future)
+            self.pending_response = []
+
+            try:
+                self._write_ignore_errors(line)
+
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise ModemError("Timeout waiting for response to " + line)
+            finally:
+                self.pending_command = None
+                self.pending_response = None
+
+    async def _poll(self):
+        if not self.transport:
+            if time.time() >= self.next_device_check:
+                self.next_device_check = time.time() + self.device_check_interval
+                await self._check_device()
+        elif self.prev_line_time < time.time() - self.poll_interval:
+            try:
+                await self.command("AT")
+            except ModemError as e:
+                log.warning("Modem not responding, reconnecting: %s", e)
+
+                self._close_port()
+                self.next_device_check = 0
 
         if self.ringing and self.prev_ring_time < time.time() - self.ring_timeout:
             self._ring_end()
@@ -51,97 +205,172 @@ class Modem:
         line = (line + "\r\n").encode("ascii")
 
         try:
-            self.port.write(line)
+            self.transport.write(line)
         except Exception as e:
             log.debug("Write error", exc_info=e)
 
             self._close_port()
 
+    def _fail_pending_command(self, message):
+        if self.pending_command and not self.pending_command[1].done():
+            self.pending_command[1].set_exception(ModemError(message))
+
     def _close_port(self):
+        self._fail_pending_command("Port closed")
+
         self._ring_end()
 
-        if self.port:
-            asyncio.get_event_loop().remove_reader(self.port)
-            self.port.close()
+        if self.transport:
+            self.transport.close()
 
-            self.port = None
+            self.transport = None
+            self.protocol = None
 
-    def _open_port(self):
-        self._close_port()
+    def _uevent(self, properties):
+        if properties.get("ACTION") == "add" and properties.get("SUBSYSTEM") in ("tty", "usb"):
+            utils.run_background(self._device_added())
+
+    async def _device_added(self):
+        for delay in DEVICE_SETTLE_DELAYS:
+            await asyncio.sleep(delay)
+
+            if self.transport:
+                return
+
+            await self._check_device()
+
+    async def _check_device(self):
+        if self.transport or self.checking_device:
+            return
+
+        self.checking_device = True
+
+        try:
+            if os.path.exists(self.serial_port):
+                await self._open_port()
+            elif self.mode_switch_usb_id and await asyncio.get_event_loop().run_in_executor(
+                    None, self._mode_switch_device_present):
+                await self._mode_switch()
+        finally:
+            self.checking_device = False
+
+    async def _mode_switch(self):
+        now = time.monotonic()
+
+        if (self.last_mode_switch is not None
+                and now < self.last_mode_switch + self.mode_switch_cooldown):
+            return
+
+        self.last_mode_switch = now
 
-        if not self._device_present():
-            raise Exception("Device not found")
+        log.info("Attempting USB mode switch")
+
+        proc = await asyncio.create_subprocess_shell(self.mode_switch_command)
+        returncode = await proc.wait()
+
+        if returncode != 0:
+            log.warning("USB mode switch command exited with %s", returncode)
+
+    async def _open_port(self):
+        self._close_port()
 
         log.debug("Opening " + self.serial_port)
 
         self.prev_line_time = 0
 
         try:
-            self.port = serial.Serial(
-                port=self.serial_port,
+            self.transport, self.protocol = await serial_asyncio.create_serial_connection(
+                asyncio.get_event_loop(),
+                lambda: LineFramer(self._line_received, self._connection_lost),
+                self.serial_port,
                 baudrate=9600,
                 dsrdtr=True,
-                rtscts=True,
-                timeout=0,
-                write_timeout=0)
+                rtscts=True)
         except Exception as e:
             log.debug("Failed to open port", exc_info=e)
+
+            self.next_device_check = time.time() + self.poll_interval
             return
 
-        self._write_ignore_errors("AT")
-        self._write_ignore_errors("AT+CLIP=1")
+        try:
+            await self.command("AT")
+            await self.command("AT+CLIP=1")
+        except ModemError as e:
+            log.warning("Modem initialization failed: %s", e)
 
-        asyncio.get_event_loop().add_reader(self.port, self._reader)
+            self._close_port()
+            self.next_device_check = time.time() + self.poll_interval
 
-    def _reader(self):
-        try:
-            self.rx_buf += self.port.read(1024)
+    def _connection_lost(self, protocol, exc):
+        # Ignore the old connection going away after it has been replaced
+        if protocol is not self.protocol:
+            return
 
-            while True:
-                p = self.rx_buf.find(ord(b"\n"))
+        log.debug("Connection lost", exc_info=exc)
 
-                if p == -1:
-                    break
+        self.transport = None
+        self.protocol = None
+        self.next_device_check = time.time() + self.poll_interval
 
-                line = self.rx_buf[0:p].strip()
-                self.rx_buf = self.rx_buf[p+1:]
+        self._fail_pending_command("Connection lost")
 
-                self.prev_line_time = time.time()
+        self._ring_end()
 
-                if line:
-                    try:
-                        self._process_line(line.decode("ascii", "ignore"))
-                    except:
-                        log.error("Error processing modem line: " + str(line))
-        except Exception as e:
-            log.debug("Uncaught error in _reader", exc_info=e)
+    def _line_received(self, line):
+        self.prev_line_time = time.time()
 
-            self._close_port()
+        if line:
+            try:
+                self._process_line(line.decode("ascii", "ignore"))
+            except:
+                log.error("Error processing modem line: " + str(bytes(line)))
 
     def _process_line(self, line):
-        if line.startswith("^RSSI:"):
-            rssi = int(line.split(":")[1].strip())
-
-            if self.on_rssi:
-                self.on_rssi(rssi)
-        elif line.startswith("+CLIP:"):
-            number = line.split(":")[1].strip().split(",")[0].strip(" \"")
-            if number:
-                if number.startswith("0"):
-                    number = self.default_country_prefix + number[1:]
-            else:
-                number = None
-
-            if not self.ringing or number != self.ringing_number:
-                self.ringing = True
-                self.ringing_number = number
-
-                utils.raise_event(self.on_ring_start, number)
-
-            self.prev_ring_time = time.time()
-        elif line.startswith("^CEND:"):
-            if self.ringing:
-                self._ring_end()
+        prefix, colon, rest = line.partition(":")
+
+        handler = self.handlers.get(prefix) if colon else None
+        if handler:
+            handler(rest.strip())
+        elif self.pending_command:
+            self._command_response(line)
+
+    def _command_response(self, line):
+        command, future = self.pending_command
+
+        if future.done() or line == command:
+            # Late line or command echo
+            return
+
+        if line == RESULT_OK:
+            future.set_result(self.pending_response)
+        elif line in RESULT_ERRORS or line.startswith(RESULT_ERROR_PREFIXES):
+            future.set_exception(ModemError("{} failed: {}".format(command, line)))
+        else:
+            self.pending_response.append(line)
+
+    def _rssi(self, value):
+        rssi = int(value)
+
+        if self.on_rssi:
+            self.on_rssi(rssi)
+
+    def _clip(self, value):
+        number = utils.normalize_phone_number(
+            value.split(",")[0].strip(" \""),
+            self.default_country_prefix)
+
+        if not self.ringing or number != self.ringing_number:
+            self.ringing = True
+            self.ringing_number = number
+
+            self.latency.begin("phone")
+            utils.raise_event(self.on_ring_start, number)
+
+        self.prev_ring_time = time.time()
+
+    def _call_end(self, value):
+        if self.ringing:
+            self._ring_end()
 
     def _ring_end(self):
         if not self.ringing:
@@ -152,14 +381,10 @@ class Modem:
 
         utils.raise_event(self.on_ring_end)
 
-    def _device_present(self):
-        if os.path.exists(self.serial_port):
-            return True
-
-        USB_ROOT = "/sys/bus/usb/devices"
-
-        for usbdev in os.listdir(USB_ROOT):
-            usbdev_path = os.path.join(USB_ROOT, usbdev)
+    def _mode_switch_device_present(self):
+        # Runs in an executor
+        for usbdev in os.listdir(self.usb_root):
+            usbdev_path = os.path.join(self.usb_root, usbdev)
 
             usb_id = (
                 "{0}:{1}".format(
@@ -168,9 +393,7 @@ class Modem:
                 .lower())
 
             if usb_id == self.mode_switch_usb_id:
-                log.info("Attempting USB mode switch")
-
-                os.system(self.mode_switch_command)
+                return True
 
         return False
 
@@ -185,24 +408,26 @@ class MockModem:
         self.on_ring_start = None
         self.on_ring_end = None
 
+        self.latency = latency.Tracer()
+
         self.mock.add_listener("r", self._ring)
         self.mock.add_listener("h", self._ring_end)
 
     def start(self):
         self.mock.log("Modem started")
 
-    def hangup(self):
+    async def hangup(self):
         if self.ringing:
             self.mock.log("Modem hanged up")
 
     def _ring(self, number=None):
-        if number and number.startswith("0"):
-            number = self.default_country_prefix + number[1:]
+        number = utils.normalize_phone_number(number, self.default_country_prefix)
 
         if not self.ringing or number != self.ringing_number:
             self.ringing = True
             self.ringing_number = number
 
+            self.latency.begin("phone")
             utils.raise_event(self.on_ring_start, number)
 
     def _ring_end(self):
@@ -1,17 +1,39 @@
+import array
 import asyncio
 import binascii
+import collections
+import functools
 import logging
 import math
 import re
 import simpleaudio
 import serial_asyncio
 import struct
+import sys
 import time
+import latency
 import utils
 from PIL import Image, ImageDraw, ImageFont
 
 log = logging.getLogger("reader")
 
+# Asks for the optional features the firmware supports, answered with c followed by a space
+# separated list
+FEATURES_CMD = b"C"
+
+POLL_CMD = b"P"
+
+# Firmware that reports push sends r and b events on its own once enabled with E 0x01. Polls are
+# then only used to check that the reader is still there.
+PUSH_CMD = b"E"
+KEEPALIVE_INTERVAL = 5
+
+# Pipelining is used if the firmware reports window=N or push in its features. Commands are then
+# prefixed with # and a sequence number, which the firmware echoes in front of the response.
+MAX_WINDOW = 8
+MAX_PIPELINE_FAILURES = 3
+RESPONSE_TIMEOUT = 1
+
 # otf2bdf -l "45 48_57" -p 40 -o dejavu.bdf /usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf
 # >>> from PIL import BdfFontFile
 # >>> b = BdfFontFile.BdfFontFile(open("dejavu.bdf", "rb"))
@@ -26,8 +48,7 @@ def sequence(func):
 
             self.beep([])
             self.set_led(False)
-            with self.draw():
-                pass
+            self.draw_frame(BLANK_FRAME)
 
         if self.current_seq:
             self.current_seq.cancel()
@@ -72,6 +93,221 @@ def mml(mml):
 
     return r
 
+def encode_image(image):
+    # The display takes 8 pixel high pages, one byte per column with the top pixel in the lowest bit.
+    # Rotated clockwise each column becomes a row of packed bytes, one byte per page in reverse
+    # order and with the bottom pixel of the page in the lowest bit.
+    pages = image.height // 8
+    raw = image.transpose(Image.ROTATE_270).tobytes()
+
+    return b"".join(raw[pages - 1 - page::pages] for page in range(pages))
+
+DISPLAY_WIDTH = 128
+DISPLAY_PAGES = 8
+
+BLANK_FRAME = bytes(DISPLAY_WIDTH * DISPLAY_PAGES)
+
+# The progress bar in show_unlocked takes the whole last page
+PROGRESS_BAR_OFFSET = (DISPLAY_PAGES - 1) * DISPLAY_WIDTH
+
+FRAME_CACHE_SIZE = 512
+
+def progress_bar(w):
+    # Encoded page with columns 0-w filled and an outline around the rest
+    w = max(0, min(w, DISPLAY_WIDTH - 1))
+
+    return (b"\xff" * (w + 1) + b"\x81" * (DISPLAY_WIDTH - 2 - w))[:DISPLAY_WIDTH - 1] + b"\xff"
+
+def format_date(t):
+    return time.strftime("%Y-%m-%d", time.localtime(t))
+
+def dirty_regions(previous, frame):
+    # Returns (page, first column, last column) for each page that differs between two encoded
+    # frames. The columns are found by XORing each page as one big integer.
+    regions = []
+
+    for page in range(DISPLAY_PAGES):
+        start = page * DISPLAY_WIDTH
+        end = start + DISPLAY_WIDTH
+
+        diff = (int.from_bytes(previous[start:end], "big")
+            ^ int.from_bytes(frame[start:end], "big"))
+        if not diff:
+            continue
+
+        first = DISPLAY_WIDTH - 1 - (diff.bit_length() - 1) // 8
+        last = DISPLAY_WIDTH - 1 - ((diff & -diff).bit_length() - 1) // 8
+
+        regions.append((page, first, last))
+
+    return regions
+
+def partial_update(previous, frame):
+    # U followed by (page, first column, column count, data) for each changed region
+    cmd = bytearray(b"U")
+
+    for page, first, last in dirty_regions(previous, frame):
+        start = page * DISPLAY_WIDTH
+        cmd += bytes([page, first, last - first + 1])
+        cmd += frame[start + first:start + last + 1]
+
+    return bytes(cmd)
+
+_RUN = re.compile(rb"(.)\1{2,}", re.DOTALL)
+
+def _xor(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+def compress_frame(frame, previous):
+    # The frame is XORed with the previous one, which leaves mostly zeros, and then run-length
+    # encoded like PackBits: a control byte n < 128 is followed by n + 1 literal bytes, n >= 128 by
+    # one byte repeated n - 125 times.
+    data = _xor(frame, previous)
+    out = bytearray()
+    pos = 0
+
+    def literal(end):
+        for i in range(pos, end, 128):
+            chunk = data[i:min(i + 128, end)]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+
+    for m in _RUN.finditer(data):
+        literal(m.start())
+
+        length = m.end() - m.start()
+        while length >= 3:
+            n = min(length, 130)
+            out.append(n + 125)
+            out.append(data[m.start()])
+            length -= n
+
+        # One or two bytes left over go with the next literal
+        pos = m.end() - length
+
+    literal(len(data))
+
+    return bytes(out)
+
+def decompress_frame(data, previous):
+    # Reference for the firmware side of compress_frame
+    out = bytearray()
+    i = 0
+
+    while i < len(data):
+        n = data[i]
+
+        if n < 128:
+            out += data[i + 1:i + 2 + n]
+            i += 2 + n
+        else:
+            out += data[i + 1:i + 2] * (n - 125)
+            i += 2
+
+    if len(out) != len(previous):
+        raise ValueError("Decompressed frame has the wrong size")
+
+    return _xor(bytes(out), previous)
+
+SAMPLE_RATE = 44100
+LOOP_SAMPLES = 4096
+
+@functools.lru_cache(maxsize=256)
+def _wave_loop(freq, duty):
+    # A whole number of periods about LOOP_SAMPLES long, so that repeating it keeps the pitch within
+    # a fraction of a cent. Each sample is a square wave made of the first five odd harmonics.
+    cycles = max(1, round(LOOP_SAMPLES * freq / SAMPLE_RATE))
+    length = round(cycles * SAMPLE_RATE / freq)
+    step = cycles * 2 * math.pi / length
+    amplitude = (duty / 128) * ((2 << 14) - 1)
+
+    def sample(angle):
+        value = (math.sin(angle) + math.sin(angle * 3) / 3 + math.sin(angle * 5) / 5
+            + math.sin(angle * 7) / 7 + math.sin(angle * 9) / 9)
+        return max(-32768, min(int(value * amplitude), 32767))
+
+    samples = array.array("h", (sample(i * step) for i in range(length)))
+    if sys.byteorder != "little":
+        samples.byteswap()
+
+    return samples.tobytes()
+
+@functools.lru_cache(maxsize=16)
+def render_notes(notes):
+    # notes is a tuple of beep notes, returns 16-bit mono samples. The phase carries over from one
+    # note to the next like a free running oscillator, so there are no clicks between notes.
+    data = bytearray()
+    angle = 0
+
+    for (freq, length, duty) in notes:
+        count = int(length * 0.005 * SAMPLE_RATE)
+
+        if freq <= 0 or duty == 0:
+            data += bytes(count * 2)
+            angle += max(freq, 0) * 2 * math.pi / SAMPLE_RATE * count
+            continue
+
+        loop = _wave_loop(freq, duty)
+        loop_samples = len(loop) // 2
+        step = max(1, round(LOOP_SAMPLES * freq / SAMPLE_RATE)) * 2 * math.pi / loop_samples
+
+        # Start from the sample in the loop closest to the current phase
+        start = round(angle % (2 * math.pi) / step) % loop_samples
+        size = count * 2
+
+        head = loop[start * 2:start * 2 + size]
+        data += head
+        data += loop * ((size - len(head)) // len(loop))
+        data += loop[:(size - len(head)) % len(loop)]
+
+        angle = ((start + count) % loop_samples) * step
+
+    return bytes(data)
+
+class CommandQueue:
+    # Holds at most one pending command of each kind, a newer one replaces the older one in place.
+    # Kinds in PRIORITY are sent before the rest, otherwise in the order they were queued.
+    PRIORITY = (b"R", FEATURES_CMD, PUSH_CMD, b"B")
+
+    def __init__(self):
+        self.priority = collections.deque()
+        self.normal = collections.deque()
+        self.pending = {}
+
+        self.max_depth = 0
+        self.sent = collections.Counter()
+        self.dropped = collections.Counter()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, kind, payload):
+        if kind in self.pending:
+            self.dropped[kind] += 1
+        else:
+            (self.priority if kind in self.PRIORITY else self.normal).append(kind)
+
+        self.pending[kind] = payload
+        self.max_depth = max(self.max_depth, len(self.pending))
+
+    def pop(self):
+        kind = (self.priority or self.normal).popleft()
+
+        return kind, self.pending.pop(kind)
+
+    def clear(self):
+        self.priority.clear()
+        self.normal.clear()
+        self.pending.clear()
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "max_depth": self.max_depth,
+            "sent": { kind.decode("ascii"): n for kind, n in self.sent.items() },
+            "dropped": { kind.decode("ascii"): n for kind, n in self.dropped.items() },
+        }
+
 class Draw:
     def __init__(self, reader):
         self.reader = reader
@@ -93,6 +329,21 @@ class BaseReader:
 
         self.current_seq = None
 
+        # Replaced with the door's tracer when the reader belongs to one
+        self.latency = latency.Tracer()
+
+        # Encoded contents of the display, None when unknown
+        self.framebuffer = None
+
+        # Encoded show_unlocked frames without the progress bar, keyed by (icon, name, expiration
+        # date, inverted expiration date). Most recently used last.
+        self.header_frames = collections.OrderedDict()
+        self.warm_task = None
+
+        # IDs of members who recently opened the door with a tag, most recent last. Their headers are
+        # rendered again when the members change, since a renewal changes the expiration date.
+        self.recent_tag_members = collections.OrderedDict()
+
         self.font = ImageFont.load(utils.basedir() + "res/spleen.pil")
 
         self.icons20 = load_icons(utils.basedir() + "res/icons-20.png", 20, [
@@ -105,9 +356,88 @@ class BaseReader:
             "unlocked", "locked",
         ])
 
+        self.icon_frames = {
+            name:self.render(lambda draw: draw.paste(icon, (64 - 20, 32 - 20)))
+            for name, icon
+            in self.icons40.items()
+        }
+
     def draw(self):
         return Draw(self)
 
+    def render(self, func):
+        d = Draw(self)
+        func(d.draw)
+        return encode_image(d.img)
+
+    def draw_image(self, image):
+        self.draw_frame(encode_image(image))
+
+    def draw_frame(self, frame):
+        if frame == self.framebuffer:
+            return
+
+        self.framebuffer = frame
+
+        self.show_frame(frame)
+
+    def get_queue_stats(self):
+        return None
+
+    def header_frame(self, method, name, expires, inverted):
+        key = (method, name, expires, inverted)
+
+        frame = self.header_frames.get(key)
+        if frame is not None:
+            self.header_frames.move_to_end(key)
+            return frame
+
+        def draw_header(draw):
+            draw.paste(self.icons20[method], (0, 4))
+
+            draw.text((24, 2), name, fill=1, font=self.font)
+
+            if inverted:
+                draw.rectangle((0, 28, 128, 48), fill=1)
+                draw.text((0, 26), expires, fill=0, font=self.font)
+            else:
+                draw.text((0, 26), expires, fill=1, font=self.font)
+
+        frame = self.render(draw_header)
+
+        self.header_frames[key] = frame
+        if len(self.header_frames) > FRAME_CACHE_SIZE:
+            self.header_frames.popitem(last=False)
+
+        return frame
+
+    def warm_frames(self, members):
+        # members is a list of (member, is_expired) from recent_tag_members. Only tag reads get
+        # warmed headers, calls take seconds to connect anyway.
+        if self.warm_task:
+            self.warm_task.cancel()
+
+        self.warm_task = utils.run_background(self._warm_header_frames(members))
+
+    async def _warm_header_frames(self, members):
+        start = time.perf_counter()
+        count = 0
+
+        for member, is_expired in members:
+            name = member.public_name or member.name
+            expires = format_date(member.active_until)
+
+            self.header_frame("tag", name, expires, False)
+            count += 1
+
+            if is_expired:
+                self.header_frame("tag", name, expires, True)
+                count += 1
+
+            await asyncio.sleep(0)
+
+        log.debug("Warmed %s display frames in %.1f ms", count, (time.perf_counter() - start) * 1000)
+
     def _sad_sound(self):
         self.beep([(523, 20, 32), (0, 10, 0), (494, 60, 32)])
 
@@ -127,7 +457,7 @@ class BaseReader:
     async def show_membership_not_active(self, member):
         self.beep(mml("A#20 R10 A60"))
 
-        expires = time.strftime("%Y-%m-%d", time.localtime(member.active_until))
+        expires = format_date(member.active_until)
 
         with self.draw() as draw:
             draw.paste(self.icons20["error"], (0, 4))
@@ -138,9 +468,17 @@ class BaseReader:
         await asyncio.sleep(5)
 
     @sequence
-    async def show_unlocked(self, member, unlocked_until, method):
-        is_expired = (member.get_days_until_expiration() < 0)
-        expires = time.strftime("%Y-%m-%d", time.localtime(member.active_until))
+    async def show_unlocked(self, member, unlocked_until, method, is_expired):
+        name = member.public_name or member.name
+        expires = format_date(member.active_until)
+
+        if method == "tag":
+            self.recent_tag_members[member.id] = True
+            self.recent_tag_members.move_to_end(member.id)
+
+            # Leave room for frames rendered on demand
+            if len(self.recent_tag_members) > FRAME_CACHE_SIZE // 2:
+                self.recent_tag_members.popitem(last=False)
 
         start = time.time()
         buzz = [(440, 200, 16)] * math.ceil(unlocked_until - start)
@@ -153,20 +491,10 @@ class BaseReader:
 
         i = 0
         while time.time() < unlocked_until:
-            with self.draw() as draw:
-                draw.paste(self.icons20[method], (0, 4))
+            header = self.header_frame(method, name, expires, is_expired and (i % 10) < 5)
 
-                draw.text((24, 2), member.public_name or member.name, fill=1, font=self.font)
-
-                if is_expired and (i % 10) < 5:
-                    draw.rectangle((0, 28, 128, 48), fill=1)
-                    draw.text((0, 26), expires, fill=0, font=self.font)
-                else:
-                    draw.text((0, 26), expires, fill=1, font=self.font)
-
-                w = int((unlocked_until - time.time()) / ((unlocked_until - start) or 1) * 128)
-                draw.rectangle((0, 56, w, 63), fill=1)
-                draw.rectangle((0, 56, 127, 63), outline=1, width=1)
+            w = int((unlocked_until - time.time()) / ((unlocked_until - start) or 1) * 128)
+            self.draw_frame(header[:PROGRESS_BAR_OFFSET] + progress_bar(w))
 
             await asyncio.sleep(0.1)
 
@@ -185,13 +513,11 @@ class BaseReader:
         ])
 
         for _ in range(3):
-            with self.draw() as draw:
-                draw.paste(self.icons40["locked"], (64 - 20, 32 - 20))
+            self.draw_frame(self.icon_frames["locked"])
 
             await asyncio.sleep(0.5)
 
-            with self.draw() as draw:
-                pass
+            self.draw_frame(BLANK_FRAME)
 
             await asyncio.sleep(0.5)
 
@@ -206,8 +532,7 @@ class BaseReader:
             ] * 2)
 
         for i in range(0, 8):
-            with self.draw() as draw:
-                draw.paste(self.icons40["bell_{}".format(i % 4)], (64 - 20, 32 - 20))
+            self.draw_frame(self.icon_frames["bell_{}".format(i % 4)])
 
             self.set_led((i % 4) < 2)
 
@@ -218,7 +543,29 @@ class Reader(BaseReader):
         super().__init__()
 
         self.settings = settings
-        self.queue = []
+        self.queue = CommandQueue()
+
+        # Last frame sent to the display, None when unknown
+        self.display_frame = None
+
+        # Set of optional firmware features, None until the firmware has answered the query
+        self.features = None
+        self.window = 1
+        self.push = False
+        self.pipeline_failures = 0
+
+        # Set when there is something to send or a response has arrived
+        self.wakeup = asyncio.Event()
+        self.last_error = None
+
+        # Without push, poll quickly for a while after something has happened and slower otherwise
+        self.poll_interval = settings.getint("poll_interval_ms", fallback=20) / 1000
+        self.idle_poll_interval = settings.getint("idle_poll_interval_ms", fallback=100) / 1000
+        self.idle_after = settings.getint("idle_after_seconds", fallback=30)
+        self.last_activity = time.monotonic()
+
+        self.polls_sent = 0
+        self.poll_stats = (time.monotonic(), 0)
 
         self.prev_tag_read = None
         self.prev_tag_read_time = None
@@ -227,48 +574,128 @@ class Reader(BaseReader):
         utils.run_background(self._poll_task())
 
     def set_led(self, on):
-        self._send_command(b"L\x01" if on else b"L\x00")
+        self._put(b"L", b"\x01" if on else b"\x00")
 
     def beep(self, notes):
-        self._send_command(
-            b"B"
-            + b"".join(struct.pack("<hBB", *n) for n in notes))
+        self._put(b"B", b"".join(struct.pack("<hBB", *n) for n in notes))
 
-    def draw_image(self, image):
-        data = image.getdata(0)
-        encoded = bytearray()
+    def show_frame(self, frame):
+        # The command is built when the frame is sent because frames queued in between may have
+        # been replaced
+        self._put(b"D", frame)
 
-        for line in range(0, 8):
-            for x in range(0, 128):
-                byte = 0
+    def get_queue_stats(self):
+        now = time.monotonic()
+        since, polls = self.poll_stats
+        self.poll_stats = (now, self.polls_sent)
 
-                for y in range(line*8, line*8+8):
-                    byte >>= 1
+        stats = self.queue.stats()
+        stats["push"] = self.push
+        stats["poll_rate"] = round((self.polls_sent - polls) / ((now - since) or 1), 1)
 
-                    if data[y*image.width + x]:
-                        byte |= 0x80
+        return stats
 
-                encoded.append(byte)
+    def _frame_command(self, frame):
+        previous = self.display_frame
+        self.display_frame = frame
 
-        self._send_command(b"D" + encoded)
+        if frame == previous:
+            return None
 
-    def _reset(self):
-        self.queue = []
-        self._send_command(b"R")
+        # Whichever of the encodings the firmware supports is shortest on the wire. Firmware
+        # without them only gets full frames.
+        candidates = [b"D" + frame]
+
+        if previous is not None and self.features:
+            if "partial" in self.features:
+                candidates.append(partial_update(previous, frame))
+
+            if "rle" in self.features:
+                candidates.append(b"Z" + compress_frame(frame, previous))
+
+        return min(candidates, key=lambda cmd: len(self._escape(cmd)))
+
+    def _next_command(self):
+        while self.queue:
+            kind, payload = self.queue.pop()
+
+            if kind == b"D":
+                cmd = self._frame_command(payload)
+                if cmd is None:
+                    self.queue.dropped[kind] += 1
+                    continue
+            else:
+                cmd = kind + payload
+
+            self.queue.sent[kind] += 1
+
+            return cmd
 
-        with self.draw():
+        return POLL_CMD
+
+    def _put(self, kind, payload):
+        self.queue.put(kind, payload)
+        self.last_activity = time.monotonic()
+        self.wakeup.set()
+
+    def _current_poll_interval(self):
+        if self.push:
+            return KEEPALIVE_INTERVAL
+
+        if time.monotonic() < self.last_activity + self.idle_after:
+            return self.poll_interval
+
+        return self.idle_poll_interval
+
+    async def _wait(self, timeout):
+        self.wakeup.clear()
+
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
             pass
 
-    def _send_command(self, cmd):
-        self.queue.insert(
-            0,
-            cmd.replace(b"\\", b"\\\\").replace(b"\n", b"\\n") + b"\n")
+    def _reset(self):
+        self.queue.clear()
+        self.framebuffer = None
+        self.display_frame = None
+        self.features = None
+        self.window = 1
+        self.push = False
+        self._put(b"R", b"")
+        self._put(FEATURES_CMD, b"")
+
+        self.draw_frame(BLANK_FRAME)
+
+    def _escape(self, cmd):
+        return cmd.replace(b"\\", b"\\\\").replace(b"\n", b"\\n") + b"\n"
+
+    def _unescape(self, data):
+        return data.replace(b"\\n", b"\n").replace(b"\\\\", b"\\")
+
+    def _set_features(self, payload):
+        self.features = set(payload.decode("utf-8", "replace").split())
+        self.window = 1
+
+        for feature in self.features:
+            if feature.startswith("window="):
+                try:
+                    self.window = max(1, min(int(feature[len("window="):]), MAX_WINDOW))
+                except ValueError:
+                    pass
+
+        # Pushed events are only read in the pipelined path, so push stays off once the reader has
+        # fallen back to stop-and-wait
+        self.push = "push" in self.features and self.pipeline_failures < MAX_PIPELINE_FAILURES
+        if "push" in self.features:
+            self._put(PUSH_CMD, b"\x01" if self.push else b"\x00")
+
+        log.info("Reader firmware features: %s", ", ".join(sorted(self.features)) or "none")
 
     async def _poll_task(self):
         if not self.settings.get("serial_port", fallback=None):
             return
 
-        last_error = None
         reader = None
         writer = None
         while True:
@@ -287,64 +714,184 @@ class Reader(BaseReader):
 
                 log.debug("reader opened successfully")
 
+                self.pipeline_failures = 0
                 self._reset()
 
-                cur_cmd = None
-                timeouts = 0
-
                 while True:
-                    if len(self.queue) == 0:
-                        await asyncio.sleep(0.020)
+                    await self._stop_and_wait(reader, writer)
+                    await self._pipelined(reader, writer)
+
+            except Exception as ex:
+                msg = str(ex)
+                if msg != self.last_error:
+                    self.last_error = msg
+                    log.error("Error: " + msg)
+
+                await asyncio.sleep(1)
 
-                    if not cur_cmd:
-                        cur_cmd = self.queue.pop() if len(self.queue) else b"P\n"
+    async def _stop_and_wait(self, reader, writer):
+        # Sends one command at a time and waits for its response. Returns once the firmware has
+        # reported that it can pipeline or push.
+        cur_cmd = None
+        timeouts = 0
 
-                    #if cur_cmd != b"P\n":
-                    #    print("write", cur_cmd[:10])
+        while True:
+            if (not cur_cmd
+                    and (self.window > 1 or self.push)
+                    and self.pipeline_failures < MAX_PIPELINE_FAILURES):
+                return
+
+            if len(self.queue) == 0:
+                await self._wait(self._current_poll_interval())
 
-                    writer.write(cur_cmd)
-                    await writer.drain()
+            if not cur_cmd:
+                cur_cmd = self._next_command()
 
-                    try:
-                        response = await asyncio.wait_for(reader.readline(), 1)
-                    except asyncio.TimeoutError as ex:
-                        timeouts += 1
-                        if timeouts >= 5:
-                            raise Exception("Too many timeouts")
+                if cur_cmd == POLL_CMD:
+                    self.polls_sent += 1
 
-                        log.warn("READER: Timeout")
-                        await asyncio.sleep(0.1)
-                        self._reset()
+            #if cur_cmd != POLL_CMD:
+            #    print("write", cur_cmd[:10])
 
-                        continue
+            writer.write(self._escape(cur_cmd))
+            await writer.drain()
 
+            try:
+                response = await asyncio.wait_for(reader.readline(), RESPONSE_TIMEOUT)
+            except asyncio.TimeoutError as ex:
+                if cur_cmd == FEATURES_CMD:
+                    # Older firmware ignores unknown commands
+                    self._set_features(b"")
                     cur_cmd = None
-                    timeouts = 0
-                    last_error = None
+                    continue
 
-                    self._handle_event(response)
+                timeouts += 1
+                if timeouts >= 5:
+                    raise Exception("Too many timeouts")
 
-                    await asyncio.sleep(0.001)
+                log.warn("READER: Timeout")
+                await asyncio.sleep(0.1)
+                self._reset()
 
-            except Exception as ex:
-                msg = str(ex)
-                if msg != last_error:
-                    last_error = msg
-                    log.error("Error: " + msg)
+                continue
 
-                await asyncio.sleep(1)
+            if cur_cmd == FEATURES_CMD and not response.startswith(b"c"):
+                self._set_features(b"")
 
-    def _handle_event(self, response):
-        if len(response) < 2:
-            return
+            cur_cmd = None
+            timeouts = 0
+            self.last_error = None
+
+            if len(response) >= 2:
+                self._handle_event(response[0:1], self._unescape(response[1:-1]))
+
+            await asyncio.sleep(0.001)
+
+    async def _pipelined(self, reader, writer):
+        # Keeps up to self.window commands in flight while a separate task reads responses and
+        # pushed events. Polls go out alongside the other commands so that a display frame being
+        # sent does not hold up tag reads. Returns after a reset if a response goes missing.
+        log.debug("Pipelining with a window of %s, push %s", self.window, self.push)
+
+        # sequence number -> (time sent, is poll)
+        in_flight = {}
+        seq = 0
+        last_poll = 0
+
+        receiver = asyncio.ensure_future(self._receive(reader, in_flight))
+        receiver.add_done_callback(lambda _: self.wakeup.set())
+
+        try:
+            while not receiver.done():
+                now = time.monotonic()
+                next_poll = last_poll + self._current_poll_interval()
+
+                if len(in_flight) >= self.window:
+                    cmd = None
+                elif len(self.queue):
+                    cmd = self._next_command()
+                elif now >= next_poll and not any(is_poll for _, is_poll in in_flight.values()):
+                    cmd = POLL_CMD
+                else:
+                    cmd = None
+
+                if cmd is None:
+                    await self._wait(
+                        next_poll - now if next_poll > now else self._current_poll_interval())
+                    continue
+
+                if cmd == POLL_CMD:
+                    last_poll = now
+                    self.polls_sent += 1
+
+                seq = (seq + 1) % 256
+                in_flight[seq] = (now, cmd == POLL_CMD)
+
+                writer.write(self._escape(b"#" + bytes([seq]) + cmd))
+                await writer.drain()
+        finally:
+            receiver.cancel()
+
+        # Raises if the receiver failed for some other reason than a timeout
+        await receiver
 
-        event = response[0:1]
-        payload = response[1:-1].replace(b"\\n", b"\n").replace(b"\\\\", b"\\")
+        await self._discard_input(reader)
+        self._reset()
 
+    async def _discard_input(self, reader):
+        # Late responses to the commands in flight would otherwise be taken as the responses to the
+        # commands sent after the reset. Reads until the link has been quiet for a moment.
+        deadline = time.monotonic() + RESPONSE_TIMEOUT
+
+        while time.monotonic() < deadline:
+            try:
+                line = await asyncio.wait_for(reader.readline(), 0.1)
+            except asyncio.TimeoutError:
+                return
+
+            if not line:
+                raise Exception("Reader disconnected")
+
+    async def _receive(self, reader, in_flight):
+        while True:
+            if in_flight and time.monotonic() > (
+                    min(t for t, _ in in_flight.values()) + RESPONSE_TIMEOUT):
+                self.pipeline_failures += 1
+                log.warning(
+                    "READER: Timeout with %s commands in flight (%s/%s)",
+                    len(in_flight), self.pipeline_failures, MAX_PIPELINE_FAILURES)
+                return
+
+            try:
+                line = await asyncio.wait_for(reader.readline(), 0.1)
+            except asyncio.TimeoutError:
+                continue
+
+            if not line:
+                raise Exception("Reader disconnected")
+
+            data = self._unescape(line.rstrip(b"\n"))
+
+            if data[0:1] == b"#" and len(data) >= 3:
+                if in_flight.pop(data[1], None) is None:
+                    log.warning("READER: Response to unknown command %s", data[1])
+
+                self._handle_event(data[2:3], data[3:])
+            elif data:
+                self._handle_event(data[0:1], data[1:])
+
+            self.last_error = None
+            self.wakeup.set()
+
+    def _handle_event(self, event, payload):
         if event != b"p":
             print(event, payload)
 
-        if event == b"b" and len(payload) == 1:
+            self.last_activity = time.monotonic()
+
+        if event == b"c":
+            self._set_features(payload)
+        elif event == b"b" and len(payload) == 1:
             utils.raise_event(self.on_button_change, payload == b"\x01")
         elif event == b"r" and len(payload) >= 4:
             uid = binascii.hexlify(payload).decode("utf-8")
@@ -359,18 +906,22 @@ class Reader(BaseReader):
             self.prev_tag_read = uid
             self.prev_tag_read_time = now
 
+            self.latency.begin("tag")
             utils.raise_event(self.on_tag_read, uid)
 
 class MockReader(BaseReader):
-    def __init__(self, mock):
+    def __init__(self, mock, name=None):
         super().__init__()
 
         self.mock = mock
 
         self.play_object = None
 
-        self.mock.add_listener("b", self._button_press)
-        self.mock.add_listener("t", self._tag_read)
+        # With several doors the commands are suffixed with the door name, e.g. t.workshop
+        suffix = "" if name is None else "." + name
+
+        self.mock.add_listener("b" + suffix, self._button_press)
+        self.mock.add_listener("t" + suffix, self._tag_read)
 
     def start(self):
         pass
@@ -386,40 +937,27 @@ class MockReader(BaseReader):
         if len(notes) == 0:
             return
 
-        RATE = 44100
-        angle = 0
-        data = bytearray()
-
-        for (freq, length, duty) in notes:
-            step = freq * 2 * math.pi / RATE
-
-            for t in range(0, int(length * 0.005 * RATE)):
-                sample = (math.sin(angle) + math.sin(angle * 3) / 3 + math.sin(angle * 5) / 5
-                    + math.sin(angle * 7) / 7 + math.sin(angle * 9) / 9) * (duty / 128)
-                isample = int(sample * ((2 << 14) - 1))
-                angle += step
+        data = render_notes(tuple(tuple(n) for n in notes))
 
-                data += struct.pack("<h", isample)
-
-        self.play_object = simpleaudio.play_buffer(data, 1, 2, RATE)
-
-    def draw_image(self, image):
-        data = image.getdata(0)
+        self.play_object = simpleaudio.play_buffer(data, 1, 2, SAMPLE_RATE)
 
+    def show_frame(self, frame):
         encoded = ""
         encoded += "┌" + "─" * 64 + "┐\n"
 
         for cy in range(0, 64, 4):
             encoded += "│"
 
-            for cx in range(0, 128, 2):
-                c = 0
+            page = (cy // 8) * DISPLAY_WIDTH
+            shift = cy % 8
 
-                for x, y in [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2), (0, 3), (1, 3)]:
-                    c >>= 1
+            for cx in range(0, 128, 2):
+                left = frame[page + cx] >> shift
+                right = frame[page + cx + 1] >> shift
 
-                    if data[(cy + y)*image.width + (cx + x)]:
-                        c |= 0x80
+                # Braille dots 1-3 and 7 are the left column, 4-6 and 8 the right one
+                c = ((left & 0x07) | (right & 0x07) << 3
+                    | (left & 0x08) << 3 | (right & 0x08) << 4)
 
                 encoded += chr(c + 0x2800)
 
@@ -442,4 +980,5 @@ class MockReader(BaseReader):
         utils.run_background(simulate())
 
     def _tag_read(self, uid):
+        self.latency.begin("tag")
         utils.raise_event(self.on_tag_read, uid)
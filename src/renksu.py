@@ -2,13 +2,15 @@ import os.path
 import logging, logging.config
 logging.config.fileConfig(os.path.dirname(__file__) + "/../logging.ini")
 
-import asyncio
 import configparser
+import json
 import sys
 import time
 
+import access
 import database
 import door
+import latency
 import modem
 import mqtt
 import reader
@@ -19,72 +21,104 @@ import utils
 log = logging.getLogger("renksu")
 audit_log = logging.getLogger("audit")
 
-class Renksu:
-    def __init__(self, mock=None):
+class DoorController:
+    # One door with its own reader, lock and access policy. With a name, its settings come from the
+    # [door.name], [reader.name] and [membership.name] sections and its MQTT topics are under
+    # doors/name/. Without one it uses the plain sections and topics.
+
+    def __init__(self, app, name, mock=None):
         def mocked(name):
             return mock and mock.is_mocked(name)
 
-        self.settings = configparser.ConfigParser(allow_no_value=True)
-        self.settings.read(utils.basedir() + "../settings.ini")
-
-        self.db = database.Database(settings=self.settings["database"])
+        def section(base):
+            return base if name is None else "{}.{}".format(base, name)
 
-        self.speaker = speaker.Speaker(["doorbell", "bleep"])
+        self.app = app
+        self.name = name
+        self.settings = app.settings
 
-        self.telegram = (
-            telegram.MockTelegram(mock)
-            if mocked("telegram")
-            else telegram.Telegram(self.settings["telegram"]))
+        self.topic_prefix = "" if name is None else "doors/{}/".format(name)
+        self.label = self.settings.get(section("door"), "label", fallback=name)
 
-        self.modem = (
-            modem.MockModem(mock, self.settings["modem"])
-            if mocked("modem")
-            else modem.Modem(self.settings["modem"]))
+        membership = (
+            section("membership")
+            if self.settings.has_section(section("membership"))
+            else "membership")
 
-        self.modem.on_ring_start = self.ring_start
-        self.modem.on_ring_end = self.ring_end
+        self.access = access.AccessPolicy(
+            self.settings.getint(membership, "grace_period_days", fallback=0),
+            self.settings.getint(membership, "remaining_message_days", fallback=0))
 
         self.door = (
-            door.MockDoor(mock, self.settings["door"])
+            door.MockDoor(mock, self.settings[section("door")], name)
             if mocked("door")
-            else door.Door(self.settings["door"]))
+            else door.Door(self.settings[section("door")]))
         self.door.on_open_change = self.door_open_change
         self.door.on_unlocked_change = self.door_unlocked_change
 
         self.reader = (
-            reader.MockReader(mock)
+            reader.MockReader(mock, name)
             if mocked("reader")
-            else reader.Reader(self.settings["reader"]))
+            else reader.Reader(self.settings[section("reader")]))
         self.reader.on_tag_read = self.tag_read
         self.reader.on_button_change = self.doorbell_button_change
 
+        # Traces from this door's reader (and the modem if calls open it) to its lock
+        self.latency = latency.Tracer()
+        self.door.latency = self.latency
+        self.reader.latency = self.latency
+
         self.last_unlocked_by = None
         self.last_opened_at = None
 
         self.say_after_open_text = None
         self.say_after_open_time = 0
 
-        self.mqtt = mqtt.MqttClient(self.settings["mqtt"])
-        self.mqtt.on_light_on_change = self.light_on_change
-
-        self.presence_timer = None
-        self.presence_members = {}
-        self.presence = None
+        self.unknown_tag_coalesce_seconds = self.settings.getint(
+            section("reader"), "unknown_tag_coalesce_seconds", fallback=10)
+        self.last_unknown_tag = None
+        self.last_unknown_tag_time = 0
+        self.unknown_tags_coalesced = 0
 
     def start(self):
-        log.info("Starting up")
-
-        self.mqtt.start()
-        self.db.start()
         self.door.start()
-        self.modem.start()
         self.reader.start()
 
+    def publish(self, topic, payload, retain=False):
+        self.app.mqtt.publish(self.topic_prefix + topic, payload, retain)
+
+    def audit(self, msg, *args):
+        audit_log.info(msg if self.name is None else "[{}] {}".format(self.name, msg), *args)
+
+    def describe(self, text):
+        # Messages name the door when there are several
+        return text if self.name is None else "{} ({})".format(text, self.label)
+
+    def publish_stats(self):
+        self.publish("stats/latency", json.dumps(self.latency.summary()))
+
+        queue_stats = self.reader.get_queue_stats()
+        if queue_stats is not None:
+            self.publish("stats/reader_queue", json.dumps(queue_stats))
+
+    def database_update(self, members):
+        self.access.rebuild(members)
+
+        recent = self.reader.recent_tag_members
+
+        self.reader.warm_frames([
+            (m, decision.is_expired)
+            for m, decision in ((m, self.access.decide(m)) for m in members if m.id in recent)
+            if decision.allowed
+        ])
+
+        self.last_unknown_tag = None
+
     def doorbell_button_change(self, pushed):
         if pushed and not self.door.is_unlocked:
             self.reader.show_doorbell()
-            self.speaker.play("doorbell")
-            self.mqtt.publish("doorbell", None)
+            self.app.speaker.play("doorbell")
+            self.publish("doorbell", None)
 
     def say_after_open(self, text):
         self.say_after_open_text = text
@@ -93,107 +127,84 @@ class Renksu:
     async def tag_read(self, uid):
         #print("Tag read: aaa ", uid)
 
+        self.latency.mark("on_tag_read")
+
         if not uid:
             return
 
-        audit_log.info("RFID tag read")
-
-        member = await self.db.get_member_by_tag_id(uid)
-
-        if member is None:
-            audit_log.info("-> Tag not in database")
-
-            self.mqtt.publish("reader/unknown_tag", None)
-
-            if not self.door.is_unlocked:
-                self.reader.show_unknown("Unknown tag", sound=True)
+        now = time.time()
 
+        # Something repeatedly presenting the same unknown tag only gets reported once
+        if (uid == self.last_unknown_tag
+                and now - self.last_unknown_tag_time < self.unknown_tag_coalesce_seconds):
+            self.last_unknown_tag_time = now
+            self.unknown_tags_coalesced += 1
             return
 
-        await self.maybe_unlock_for_member(member, "tag")
-
-    async def ring_start(self, number):
-        audit_log.info("Incoming call from %s", number)
-
-        if number is None:
-            audit_log.info("-> Hidden number")
-
-            self.mqtt.publish("ring/hidden_number", None)
-            self.reader.show_unknown("Hidden number")
+        self.audit("RFID tag read")
 
-            self.speaker.play("doorbell")
-            self.telegram.message("\U0001F514 Joku soitti ovikelloa piilotetusta numerosta.")
-            return
+        member = await self.app.db.get_member_by_tag_id(uid)
 
-        member = await self.db.get_member_by_number(number)
+        self.latency.mark("lookup")
 
         if member is None:
-            audit_log.info("-> Number not in database")
+            self.audit("-> Tag not in database")
 
-            self.mqtt.publish("ring/number_not_in_database", None)
-            self.reader.show_unknown("Unknown number")
+            self.last_unknown_tag = uid
+            self.last_unknown_tag_time = now
 
-            self.speaker.play("doorbell")
-            self.telegram.message("\U0001F514 Joku soitti ovikelloa numerosta, joka ei ole jäsenrekisterissä.")
-            return
+            self.publish("reader/unknown_tag", None)
 
-        await self.maybe_unlock_for_member(member, "phone")
+            if not self.door.is_unlocked:
+                self.reader.show_unknown("Unknown tag", sound=True)
 
-        await asyncio.sleep(2)
+            return
 
-        self.modem.hangup()
+        await self.maybe_unlock_for_member(member, "tag")
 
     async def maybe_unlock_for_member(self, member, method):
         now = time.time()
 
-        days_left = member.get_days_until_expiration()
+        decision = self.access.decide(member)
 
-        audit_log.info("Membership days left: {}".format(days_left))
+        self.latency.mark("decision")
 
-        presence_timeout = self.settings.getint("presence", "timeout_seconds", fallback=0)
-        grace_period = self.settings.getint("membership", "grace_period_days", fallback=0)
-        remaining_message_days = self.settings.getint("membership", "remaining_message_days", fallback=0)
+        self.audit("Membership days left: {}".format(decision.days_left))
 
-        if days_left < 0:
-            if grace_period and -days_left < grace_period:
-                self.say_after_open("Membership expired. Days of grace period remaining: {}".format(
-                    grace_period + days_left))
-            else:
-                audit_log.info("-> Not an active member!")
-                #asyncio.ensure_future(self.ring_doorbell())
+        if not decision.allowed:
+            self.audit("-> Not an active member!")
+            #asyncio.ensure_future(self.ring_doorbell())
 
-                self.mqtt.publish("ring/member_not_active", member.get_public_name())
+            self.publish("ring/member_not_active", member.get_public_name())
 
-                #self.telegram.message("\U000026D4 {} soitti ovikelloa, koska tilankäyttöoikeus ei ole voimassa."
-                #    .format(member.get_public_name()))
+            #self.telegram.message("\U000026D4 {} soitti ovikelloa, koska tilankäyttöoikeus ei ole voimassa."
+            #    .format(member.get_public_name()))
 
-                self.reader.show_membership_not_active(member)
+            self.reader.show_membership_not_active(member)
 
-                return
-        else:
-            if remaining_message_days and days_left <= remaining_message_days:
-                self.say_after_open("Days remaining: {}".format(days_left))
+            return
+
+        if decision.message:
+            self.say_after_open(decision.message)
 
-        self.mqtt.publish("ring/unlocked", member.get_public_name())
+        self.publish("ring/unlocked", member.get_public_name())
 
-        audit_log.info("Opening door for %s", member.display_name)
+        self.audit("Opening door for %s", member.display_name)
 
-        last_presence = self.presence_members.get(member.id, 0)
-        if now - last_presence >= presence_timeout:
-            self.presence_members[member.id] = now
-            self.telegram.message("\U0001F6AA {} avasi oven.".format(member.get_public_name()))
+        last_presence = self.app.presence_members.get(member.id, 0)
+        if now - last_presence >= self.app.presence_timeout:
+            self.app.presence_members[member.id] = now
+            self.app.telegram.message(
+                self.describe("\U0001F6AA {} avasi oven.".format(member.get_public_name())))
 
         if not self.door.unlock():
             return
 
         self.last_unlocked_by = member
 
-        self.speaker.play("bleep")
+        self.app.speaker.play("bleep")
 
-        self.reader.show_unlocked(member, self.door.unlocked_until, method)
-
-    def ring_end(self):
-        log.info("Incoming call ended.")
+        self.reader.show_unlocked(member, self.door.unlocked_until, method, decision.is_expired)
 
     def door_open_change(self, is_open):
         now = time.time()
@@ -202,32 +213,148 @@ class Renksu:
             self.last_opened_at = now
 
             if self.door.is_unlocked:
-                audit_log.info("Door opened while unlocked by %s.",
+                self.audit("Door opened while unlocked by %s.",
                     self.last_unlocked_by.display_name)
             else:
-                audit_log.info("Door opened manually.")
+                self.audit("Door opened manually.")
 
-                if not self.presence:
-                    self.telegram.message("\U0001F5DD Joku avasi oven manuaalisesti")
+                if not self.app.presence:
+                    self.app.telegram.message(
+                        self.describe("\U0001F5DD Joku avasi oven manuaalisesti"))
 
             if self.say_after_open_text and (time.time() - self.say_after_open_time) < 30:
-                self.speaker.say(self.say_after_open_text, delay=3)
+                self.app.speaker.say(self.say_after_open_text, delay=3)
                 self.say_after_open_text = None
         else:
-            audit_log.info("Door closed.")
+            self.audit("Door closed.")
 
-        self.mqtt.publish("door_open", "1" if is_open else "0", True)
+        self.publish("door_open", "1" if is_open else "0", True)
 
-        self.update_presence()
+        self.app.update_presence()
 
     def door_unlocked_change(self, is_unlocked):
         if is_unlocked:
-            audit_log.info("Door unlocked.")
+            self.audit("Door unlocked.")
         else:
-            audit_log.info("Door locked.")
+            self.audit("Door locked.")
 
             self.reader.show_locked()
 
+class Renksu:
+    def __init__(self, mock=None):
+        def mocked(name):
+            return mock and mock.is_mocked(name)
+
+        self.settings = configparser.ConfigParser(allow_no_value=True)
+        self.settings.read(utils.basedir() + "../settings.ini")
+
+        self.db = database.Database(settings=self.settings["database"])
+        self.db.on_update = self.database_update
+
+        self.presence_timeout = self.settings.getint("presence", "timeout_seconds", fallback=0)
+
+        self.speaker = speaker.Speaker(["doorbell", "bleep"])
+
+        self.telegram = (
+            telegram.MockTelegram(mock)
+            if mocked("telegram")
+            else telegram.Telegram(self.settings["telegram"]))
+
+        self.modem = (
+            modem.MockModem(mock, self.settings["modem"])
+            if mocked("modem")
+            else modem.Modem(self.settings["modem"]))
+
+        self.modem.on_ring_start = self.ring_start
+        self.modem.on_ring_end = self.ring_end
+
+        door_names = [
+            name.strip()
+            for name in self.settings.get("renksu", "doors", fallback="").split(",")
+            if name.strip()
+        ]
+
+        self.doors = (
+            [DoorController(self, name, mock) for name in door_names]
+            or [DoorController(self, None, mock)])
+
+        # Calls unlock this door
+        phone_door = self.settings.get("modem", "door", fallback=None)
+        self.phone_door = next((d for d in self.doors if d.name == phone_door), self.doors[0])
+        self.modem.latency = self.phone_door.latency
+
+        self.stats_interval_seconds = self.settings.getint(
+            "mqtt", "stats_interval_seconds", fallback=300)
+
+        self.mqtt = mqtt.MqttClient(self.settings["mqtt"])
+        self.mqtt.on_light_on_change = self.light_on_change
+
+        self.presence_timer = None
+        self.presence_members = {}
+        self.presence = None
+
+    def start(self):
+        log.info("Starting up")
+
+        self.mqtt.start()
+        self.db.start()
+        self.modem.start()
+
+        for d in self.doors:
+            d.start()
+
+        if self.stats_interval_seconds > 0:
+            utils.Timer(self.publish_stats, self.stats_interval_seconds, True)
+
+    def publish_stats(self):
+        stats = self.db.get_unknown_tag_stats()
+        stats["coalesced"] = sum(d.unknown_tags_coalesced for d in self.doors)
+
+        self.mqtt.publish("stats/unknown_tag_cache", json.dumps(stats))
+
+        for d in self.doors:
+            d.publish_stats()
+
+    def database_update(self, members):
+        for d in self.doors:
+            d.database_update(members)
+
+    async def ring_start(self, number):
+        self.phone_door.latency.mark("on_ring_start")
+
+        audit_log.info("Incoming call from %s", number)
+
+        if number is None:
+            audit_log.info("-> Hidden number")
+
+            self.mqtt.publish("ring/hidden_number", None)
+            self.phone_door.reader.show_unknown("Hidden number")
+
+            self.speaker.play("doorbell")
+            self.telegram.message("\U0001F514 Joku soitti ovikelloa piilotetusta numerosta.")
+            return
+
+        member = await self.db.get_member_by_number(number)
+
+        self.phone_door.latency.mark("lookup")
+
+        if member is None:
+            audit_log.info("-> Number not in database")
+
+            self.mqtt.publish("ring/number_not_in_database", None)
+            self.phone_door.reader.show_unknown("Unknown number")
+
+            self.speaker.play("doorbell")
+            self.telegram.message("\U0001F514 Joku soitti ovikelloa numerosta, joka ei ole jäsenrekisterissä.")
+            return
+
+        await self.phone_door.maybe_unlock_for_member(member, "phone")
+
+        await self.modem.hangup()
+
+    def ring_end(self):
+        log.info("Incoming call ended.")
+
     def light_on_change(self, light_on):
         if light_on and not self.presence:
             self.telegram.message("\U0001F4A1 Valot päällä, labi ei olekaan tyhjillään")
@@ -235,7 +362,7 @@ class Renksu:
         self.update_presence()
 
     def update_presence(self):
-        new_presence = self.mqtt.light_on or self.door.is_open
+        new_presence = self.mqtt.light_on or any(d.door.is_open for d in self.doors)
 
         if self.presence_timer:
             self.presence_timer.cancel()
@@ -0,0 +1,230 @@
+# Binary snapshot of the member database. It is memory-mapped on startup so that tags and phone
+# numbers can be looked up before any member has been parsed.
+#
+# Layout (little endian):
+#
+#   header       HEADER
+#   metadata     metadata_len bytes of JSON
+#   records      member_count records: RECORD followed by name, phone number, public name and
+#                tag_count tags each prefixed with a length byte
+#   tag table    tag_count TAG_ENTRY sorted by key
+#   number table number_count NUMBER_ENTRY sorted by key
+#
+# Table keys are a length byte followed by the zero-padded value, so they can be compared as bytes.
+# The checksum is a CRC-32 of everything after the header.
+#
+# Members are stored per source (the source index is in each record), the tables point to the
+# records that won when the sources were merged.
+
+import json
+import mmap
+import struct
+import zlib
+
+MAGIC = b"RNKS"
+VERSION = 3
+
+HEADER = struct.Struct("<4sHIIIIIII")
+RECORD = struct.Struct("<BqqHHHB")
+TAG_ENTRY = struct.Struct("<16sI")
+NUMBER_ENTRY = struct.Struct("<24sI")
+
+NO_PUBLIC_NAME = 0xFFFF
+
+class SnapshotError(Exception):
+    pass
+
+def _key(value, size):
+    if len(value) >= size:
+        return None
+
+    return bytes([len(value)]) + value.ljust(size - 1, b"\0")
+
+def _table(entry, keys, offsets):
+    # Values too long for the fixed-width keys are left out. They are still found once the members
+    # have been loaded from the snapshot. Packed entries sort the same way as their keys.
+    return sorted(entry.pack(key, offsets[id(m)]) for key, m in keys if key)
+
+class _Writer:
+    # Buffers writes and keeps track of the offset and checksum
+    def __init__(self, f):
+        self.f = f
+        self.buf = bytearray()
+        self.offset = HEADER.size
+        self.crc = 0
+
+    def write(self, data):
+        self.buf += data
+        self.offset += len(data)
+
+        if len(self.buf) >= 64 * 1024:
+            self.flush()
+
+    def flush(self):
+        self.crc = zlib.crc32(self.buf, self.crc)
+        self.f.write(self.buf)
+        self.buf = bytearray()
+
+def write_snapshot(f, sources, members_by_tag_id, members_by_number, metadata):
+    # sources is a list of member lists. The header is written last because it contains the
+    # checksum, so f must be seekable.
+
+    metadata = json.dumps(metadata).encode("utf-8")
+
+    f.write(bytes(HEADER.size))
+
+    w = _Writer(f)
+    w.write(metadata)
+
+    offsets = {}
+
+    for source, m in ((i, m) for i, members in enumerate(sources) for m in members):
+        offsets[id(m)] = w.offset
+
+        name = m.name.encode("utf-8")
+        phone_number = m.phone_number.encode("utf-8")
+        public_name = m.public_name.encode("utf-8") if m.public_name is not None else b""
+
+        w.write(RECORD.pack(
+            source,
+            m.id,
+            m.active_until,
+            len(name),
+            len(phone_number),
+            len(public_name) if m.public_name is not None else NO_PUBLIC_NAME,
+            len(m.tag_uids)))
+        w.write(name)
+        w.write(phone_number)
+        w.write(public_name)
+
+        for uid in m.tag_uids:
+            w.write(bytes([len(uid)]))
+            w.write(uid)
+
+    tag_table = _table(
+        TAG_ENTRY,
+        ((_key(uid, 16), m) for uid, m in members_by_tag_id.items()),
+        offsets)
+
+    tag_table_offset = w.offset
+    for entry in tag_table:
+        w.write(entry)
+
+    number_table = _table(
+        NUMBER_ENTRY,
+        ((_key(number.encode("utf-8"), 24), m) for number, m in members_by_number.items()),
+        offsets)
+
+    number_table_offset = w.offset
+    for entry in number_table:
+        w.write(entry)
+
+    w.flush()
+
+    f.seek(0)
+    f.write(HEADER.pack(
+        MAGIC,
+        VERSION,
+        len(metadata),
+        w.crc,
+        len(offsets),
+        len(tag_table),
+        tag_table_offset,
+        len(number_table),
+        number_table_offset))
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(self.mm) < HEADER.size:
+                raise SnapshotError("Snapshot truncated")
+
+            (magic, version, metadata_len, crc, self.member_count, self.tag_count,
+                self.tag_table_offset, self.number_count, self.number_table_offset) = (
+                HEADER.unpack_from(self.mm))
+
+            if magic != MAGIC:
+                raise SnapshotError("Not a snapshot file")
+
+            if version != VERSION:
+                raise SnapshotError("Unsupported snapshot version {}".format(version))
+
+            if zlib.crc32(memoryview(self.mm)[HEADER.size:]) != crc:
+                raise SnapshotError("Snapshot checksum mismatch")
+
+            self.metadata = json.loads(
+                self.mm[HEADER.size:HEADER.size + metadata_len].decode("utf-8"))
+            self.records_offset = HEADER.size + metadata_len
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+            self.mm = None
+
+    def records(self):
+        # Yields (source index, record) pairs
+        offset = self.records_offset
+
+        for _ in range(self.member_count):
+            source, record, offset = self._read_record(offset)
+            yield source, record
+
+    def find_by_tag(self, uid):
+        return self._find(self.tag_table_offset, self.tag_count, TAG_ENTRY, _key(uid, 16))
+
+    def find_by_number(self, number):
+        return self._find(
+            self.number_table_offset, self.number_count, NUMBER_ENTRY,
+            _key(number.encode("utf-8"), 24))
+
+    def _find(self, table_offset, count, entry, key):
+        if key is None:
+            return None
+
+        lo, hi = 0, count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, offset = entry.unpack_from(self.mm, table_offset + mid * entry.size)
+
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
+            else:
+                return self._read_record(offset)[1]
+
+        return None
+
+    def _read_record(self, offset):
+        mm = self.mm
+
+        source, id, active_until, name_len, phone_len, public_len, tag_count = (
+            RECORD.unpack_from(mm, offset))
+        offset += RECORD.size
+
+        name = mm[offset:offset + name_len].decode("utf-8")
+        offset += name_len
+
+        phone_number = mm[offset:offset + phone_len].decode("utf-8")
+        offset += phone_len
+
+        if public_len == NO_PUBLIC_NAME:
+            public_name = None
+        else:
+            public_name = mm[offset:offset + public_len].decode("utf-8")
+            offset += public_len
+
+        tag_uids = []
+        for _ in range(tag_count):
+            uid_len = mm[offset]
+            tag_uids.append(mm[offset + 1:offset + 1 + uid_len])
+            offset += 1 + uid_len
+
+        return source, (id, name, phone_number, active_until, public_name, tag_uids), offset
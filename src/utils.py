@@ -2,6 +2,7 @@ import asyncio
 import inspect
 import logging
 import os.path
+import re
 
 log = logging.getLogger("utils")
 
@@ -15,6 +16,19 @@ def read_file_ignore_errors(path):
     except:
         return None
 
+def normalize_phone_number(number, default_country_prefix=None):
+    if not number:
+        return None
+
+    number = re.sub(r"[\s\-().]", "", number)
+
+    if number.startswith("00"):
+        number = "+" + number[2:]
+    elif number.startswith("0") and default_country_prefix:
+        number = default_country_prefix + number[1:]
+
+    return number or None
+
 def raise_event(handler, *args):
     if not handler:
         return